@@ -1,10 +1,11 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """ Build C libraries for development. """
 from __future__ import print_function
-from BuildSrc import build_pool
+from BuildSrc import EXECUTORS, Recipes, build_pool, with_deps
 import argparse
 import functools
 import os
+import sys
 try:
     from argcomplete import autocomplete
 except ImportError:
@@ -12,147 +13,9 @@ except ImportError:
         """ Dummy func. """
         pass
 
-URL_ARGTBLE = 'http://prdownloads.sourceforge.net/argtable/argtable2-13.tar.gz'
-URL_BOOST = 'http://sourceforge.net/projects/boost/files/boost/1.57.0/' \
-            'boost_1_57_0.tar.bz2/download'
-URL_GTEST = 'https://googletest.googlecode.com/files/gtest-1.7.0.zip'
-URL_GNUMP = 'https://ftp.gnu.org/gnu/gmp/gmp-6.0.0a.tar.bz2'
-
-BUILDS = {
-    'cppunit': {
-        'name': 'cppunit',
-        'check': 'lib/libcppunit.a',
-        'url': 'git://anongit.freedesktop.org/git/libreoffice/cppunit/',
-        'cmds': [
-            './autogen.sh',
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'gtest': {
-        'name': 'gtest',
-        'check': 'lib/libgtest.a',
-        'url': URL_GTEST,
-        'cmds': [
-            'chmod u+x configure ./scripts/*',
-            './configure --prefix=TARGET',
-            'make',
-        ],
-        'globs': [
-            ('include/gtest/*', 'include/gtest/'),
-            ('include/gtest/internal/*', 'include/gtest/internal/'),
-            ('lib/.libs/*.a', 'lib/'),
-        ],
-    },
-    'boost': {
-        'name': 'boost',
-        'check': 'lib/libboost_thread.a',
-        'url': URL_BOOST,
-        'cmds': [
-            './bootstrap.sh --prefix=TARGET',
-            './b2 install',
-        ],
-        'globs': [
-            ('libs/date_time/data/*', 'share/boost/date_time/'),
-        ],
-    },
-    'jsoncpp': {
-        'name': 'jsoncpp',
-        'check': 'lib/libjsoncpp.so',
-        'url': 'https://github.com/open-source-parsers/jsoncpp',
-        'cmds': [
-            'cmake -DCMAKE_INSTALL_PREFIX=TARGET -DCMAKE_BUILD_TYPE=debug '
-                    '-DJSONCPP_LIB_BUILD_SHARED=ON .',
-            'make install',
-        ],
-    },
-    'jsonrpc': {
-        'name': 'jsonrpc',
-        'check': 'lib/libjsonrpc.so',
-        'url': 'https://github.com/cinemast/libjson-rpc-cpp',
-        'cmds': [
-            'cmake -DCMAKE_INSTALL_PREFIX=TARGET .',
-            'make -jJOBS install',
-        ],
-    },
-    'SDL': {
-        'name': 'SDL',
-        'check': 'lib/libSDL.a',
-        'url': 'http://hg.libsdl.org/SDL',
-        'cmds': [
-            'hg update SDL-1.2',
-            './autogen.sh',
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'SDL2': {
-        'name': 'SDL2',
-        'check': 'lib/libSDL2.a',
-        'url': 'http://hg.libsdl.org/SDL',
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'argtable': {
-        'name': 'argtable',
-        'check': 'lib/libargtable2.a',
-        'url': URL_ARGTBLE,
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'cunit': {
-        'name': 'cunit',
-        'check': 'lib/libcunit.a',
-        'url': 'svn://svn.code.sf.net/p/cunit/code/trunk',
-        'cmds': [
-            'sh ./bootstrap TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'gnump': {
-        'name': 'gnump',
-        'check': 'lib/libgmp.a',
-        'url': URL_GNUMP,
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS',
-            'make install',
-        ],
-    },
-    'jansson': {
-        'name': 'jansson',
-        'check': 'lib/libjansson.so',
-        'url': 'https://github.com/akheron/jansson',
-        'cmds': [
-            'autoreconf -i',
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'libuv': {
-        'name': 'libuv',
-        'check': 'lib/libuv.so',
-        'url': 'https://github.com/libuv/libuv',
-        'cmds': [
-            'sh autogen.sh',
-            './configure --prefix=TARGET',
-            'make install',
-        ],
-    },
-    'libxml': {
-        'name': 'libxml',
-        'check': 'lib/libxml2.so',
-        'url': 'ftp://xmlsoft.org/libxml2/libxml2-git-snapshot.tar.gz',
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-}
+# Recipes of GetLibs, one file per lib
+BUILDS = Recipes(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'recipes'))
 
 
 def main():
@@ -185,8 +48,12 @@ def main():
                                      RawDescriptionHelpFormatter)
     parser.add_argument('-l', '--ldir', nargs='?', default='./libs',
                         help='library directory to install to')
+    parser.add_argument('-e', '--executor', default='process',
+                        choices=sorted(EXECUTORS.keys()),
+                        help='how to run builds in parallel, '
+                        'default %(default)s')
     parser.add_argument('libs', nargs='+', help='libs selected for install',
-                        choices=sorted(BUILDS.keys(), key=str.lower))
+                        choices=sorted(BUILDS, key=str.lower))
 
     autocomplete(parser)
     args = parser.parse_args()  # Default parses argv[1:]
@@ -194,8 +61,8 @@ def main():
 
     builds = []
     actions = {}
-    for key in BUILDS.keys():
-        actions[key] = functools.partial(builds.append, BUILDS[key])
+    for key in BUILDS:
+        actions[key] = functools.partial(builds.append, key)
 
     try:
         # Need this for jam to build mpi & graph_parallel.
@@ -206,8 +73,9 @@ def main():
         for lib in args.libs:
             actions[lib]()
 
-        # Multiprocess to overlap builds
-        build_pool(builds, ldir)
+        # Multiprocess to overlap builds, deps first
+        failed = build_pool(with_deps([BUILDS[name] for name in builds],
+                                      BUILDS), ldir, executor=args.executor)
     finally:
         try:
             os.remove(config)
@@ -216,5 +84,8 @@ def main():
         except OSError:
             pass
 
+    if failed:
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+""" Benchmark BuildSrc.py offline on synthetic recipes.
+    Tarballs, git repos & fake make cmds are generated in a scratch dir,
+    archives are served by a local http server. Reports wall clock &
+    throughput of archive handling and of building the recipes serially
+    and with every executor of build_pool.
+    Startup of the tab completed scripts is timed too, importing one of
+    STARTUP_HEAVY before completion runs counts as a regression.
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+try:
+    from argcomplete import autocomplete
+except ImportError:
+    def autocomplete(_):
+        """ Dummy func. """
+        pass
+
+import BuildSrc
+
+# Stands in for configure & make, burns cpu then sleeps
+FAKE_MAKE = """\
+import os, sys, time
+cpu, nap = float(sys.argv[1]), float(sys.argv[2])
+end = time.process_time() + cpu
+while time.process_time() < end:
+    pass
+time.sleep(nap)
+for path in sys.argv[3:]:
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+"""
+# Archive kinds generated, cycled through the recipes
+ARCHIVE_KINDS = (('tar.gz', 'w:gz'), ('tar.xz', 'w:xz'), ('tar.bz2', 'w:bz2'))
+# Scripts with tab completion & modules they must not import up front
+STARTUP_SCRIPTS = ('BuildSrc', 'SysInstall', 'MkSource')
+STARTUP_HEAVY = ('apt', 'asyncio', 'concurrent.futures', 'multiprocessing',
+                 'tarfile', 'tomllib', 'zipfile')
+FIND_URLS = (
+    'http://ftp.gnu.org/gnu/make/make-4.1.tar.gz',
+    'http://downloads.sourceforge.net/project/zsh/zsh/5.0.7/'
+    'zsh-5.0.7.tar.bz2/download',
+    'http://example.com/pkg/pkg-1.2.tar.xz',
+    'http://example.com/pkg/pkg-1.2.zip',
+)
+
+
+class BenchFailed(Exception):
+    """ A bench ran but its builds didn't all succeed. """
+    pass
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """ Doesn't log every request. """
+    def log_message(self, *_):
+        pass
+
+
+class Server(object):
+    """ Local http server for a dir, runs in a thread. """
+    def __init__(self, root):
+        handler = functools.partial(QuietHandler, directory=root)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        """ Url of path relative to the served dir. """
+        return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_port, path)
+
+    def close(self):
+        """ Stop serving. """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """ Send stdout & stderr of this process & children to /dev/null. """
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(os.devnull, 'w') as null:
+        os.dup2(null.fileno(), 1)
+        os.dup2(null.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, old in zip((1, 2), saved):
+            os.dup2(old, fd)
+            os.close(old)
+
+
+def payload(rand, size):
+    """ size bytes, half random half text so compression has work. """
+    half = size // 2
+    text = b'int main(void) { return 0; }\n' * (half // 29 + 1)
+    return rand.getrandbits(8 * half).to_bytes(half, 'little') + \
+        text[:size - half]
+
+
+def make_tree(rand, files, file_kb):
+    """ List of (relative path, data) of a fake source tree. """
+    return [('src/{}/file{}.c'.format(num % 10, num),
+             payload(rand, file_kb * 1024)) for num in range(files)]
+
+
+def make_tarball(path, top, tree, mode):
+    """ Write tree under dir top into a tar at path. """
+    with tarfile.open(path, mode) as tar:
+        for name, data in tree:
+            info = tarfile.TarInfo('{}/{}'.format(top, name))
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+
+
+def make_repo(path, tree):
+    """ Bare git repo at path with tree in one commit. """
+    work = path + '.work'
+    for name, data in tree:
+        fname = os.path.join(work, name)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'wb') as fout:
+            fout.write(data)
+    with open(os.devnull, 'w') as null:
+        for cmd in (['git', 'init', '-q'], ['git', 'add', '.'],
+                    ['git', '-c', 'user.name=bench', '-c',
+                     'user.email=bench@localhost', 'commit', '-q', '-m',
+                     'Synthetic tree']):
+            subprocess.check_call(cmd, cwd=work, stdout=null)
+        subprocess.check_call(['git', 'clone', '-q', '--bare', work, path],
+                              stdout=null)
+    shutil.rmtree(work)
+
+
+def make_recipes(args, root, server):
+    """ Generate sources of the synthetic recipes under root.
+        Every fourth package is a git repo, others cycle archive kinds.
+        Every third package depends on the one before it.
+        Returns (recipes, uncompressed bytes of one tree, archive paths).
+    """
+    rand = random.Random(args.seed)
+    fake = os.path.join(root, 'fake_make.py')
+    with open(fake, 'w') as fout:
+        fout.write(FAKE_MAKE)
+    for sub in ('srv', 'git'):
+        os.makedirs(os.path.join(root, sub))
+
+    tree = make_tree(rand, args.files, args.file_kb)
+    recipes, archives = [], []
+    for num in range(args.packages):
+        name = 'pkg{}'.format(num)
+        if num % 4 == 3:
+            url = os.path.join(root, 'git', name + '.git')
+            make_repo(url, tree)
+        else:
+            ext, mode = ARCHIVE_KINDS[num % len(ARCHIVE_KINDS)]
+            fname = '{}-1.0.{}'.format(name, ext)
+            archives.append(os.path.join(root, 'srv', fname))
+            make_tarball(archives[-1], name + '-1.0', tree, mode)
+            url = server.url(fname)
+        make = '{} {} {} {}'.format(sys.executable, fake, args.cpu, args.sleep)
+        recipes.append({
+            'name': name,
+            'check': 'bin/' + name,
+            'url': url,
+            'deps': ['pkg{}'.format(num - 1)] if num % 3 == 2 else [],
+            'cmds': [
+                make,
+                make + ' TARGET/bin/' + name,
+            ],
+        })
+
+    return recipes, sum(len(data) for _, data in tree), archives
+
+
+def reset_settings(root):
+    """ Fresh caches under root, nothing shared between runs. """
+    scratch = tempfile.mkdtemp(dir=root)
+    BuildSrc.SETTINGS.update({
+        'cache_dir': os.path.join(scratch, 'cache'),
+        'log': os.path.join(scratch, 'build.jsonl'),
+        'offline': False,
+        'mirrors': True,
+        'incremental': False,
+        'artifacts': None,
+        'ccache_size': 0,
+        'build_root': None,
+    })
+    return scratch
+
+
+def timed(func, repeat):
+    """ Best wall clock of repeat calls of func(), which may prep a run
+        & return the callable to time.
+    """
+    best = None
+    for _ in range(repeat):
+        run = func()
+        start = time.time()
+        run()
+        wall = time.time() - start
+        best = wall if best is None else min(best, wall)
+    return best
+
+
+def bench_startup(module):
+    """ Start python & import module, like tab completion does. """
+    cmd = [sys.executable, '-c', 'import ' + module]
+    bindir = os.path.dirname(os.path.abspath(__file__))
+    return lambda: functools.partial(subprocess.check_call, cmd, cwd=bindir)
+
+
+def heavy_imports(module):
+    """ Modules of STARTUP_HEAVY that importing module loads,
+        found with python -X importtime.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    err = proc.communicate()[1]
+    names = set(line.rsplit('|', 1)[-1].strip() for line in err.splitlines()
+                if line.startswith('import time:'))
+    return sorted(names & set(STARTUP_HEAVY))
+
+
+def bench_find_archive(count):
+    """ Calls of find_archive per second over a mix of urls. """
+    def run():
+        for num in range(count):
+            try:
+                BuildSrc.find_archive(FIND_URLS[num % len(FIND_URLS)])
+            except BuildSrc.ArchiveNotSupported:
+                pass
+    return lambda: run
+
+
+def bench_extract(root, archive):
+    """ Extract a local archive with extract_archive. """
+    def prep():
+        dest = tempfile.mkdtemp(dir=root)
+        return lambda: BuildSrc.extract_archive(archive, dest)
+    return prep
+
+
+def bench_get_archive(root, url, cached):
+    """ get_archive from the local server, streaming into a cold cache
+        or extracting from a warm one.
+    """
+    def prep():
+        reset_settings(root)
+        if cached:
+            BuildSrc.fetch_archive(url)
+        target = os.path.join(tempfile.mkdtemp(dir=root), 'src')
+        return lambda: BuildSrc.get_archive(url, target)
+    return prep
+
+
+def check_built(builds, odir, failed=()):
+    """ Raise BenchFailed if any build failed or its check file is missing.
+        A failed build is quick, it must not pass as a fast one.
+    """
+    missing = [build['name'] for build in builds
+               if build['name'] in failed or not os.path.exists(os.path.join(
+                   BuildSrc.build_dirs(build, odir)[0], build['check']))]
+    if missing:
+        raise BenchFailed('builds failed: ' + ', '.join(missing))
+
+
+def bench_serial(root, recipes):
+    """ build_src of each recipe in order, like before build_pool. """
+    def prep():
+        odir = os.path.join(reset_settings(root), 'out')
+        builds = BuildSrc.topo_sort([dict(rec) for rec in recipes])
+
+        def run():
+            """ Build all, a failed one doesn't stop the rest. """
+            failed = []
+            for build in builds:
+                try:
+                    BuildSrc.build_src(build, odir)
+                except BuildSrc.StepFailed:
+                    failed.append(build['name'])
+            check_built(builds, odir, failed)
+        return run
+    return prep
+
+
+def bench_pool(root, recipes, jobs, executor):
+    """ build_pool of all recipes with an executor. """
+    def prep():
+        odir = os.path.join(reset_settings(root), 'out')
+        builds = [dict(rec) for rec in recipes]
+        return lambda: check_built(builds, odir, BuildSrc.build_pool(
+            builds, odir, jobs, executor))
+    return prep
+
+
+def run_benches(args, root):
+    """ Run every benchmark, returns {name: {'wall': s, 'rate': x,
+        'unit': unit}}.
+    """
+    server = Server(os.path.join(root, 'srv'))
+    try:
+        recipes, tree_bytes, archives = make_recipes(args, root, server)
+        mb = tree_bytes / 1024.0 ** 2
+        benches = [('startup ' + module, bench_startup(module), 1, 'starts/s')
+                   for module in STARTUP_SCRIPTS]
+        benches.append(('find_archive', bench_find_archive(args.finds),
+                        args.finds, 'calls/s'))
+        for archive, (kind, _) in zip(archives, ARCHIVE_KINDS):
+            url = server.url(os.path.basename(archive))
+            benches.extend([
+                ('extract_archive ' + kind, bench_extract(root, archive),
+                 mb, 'MB/s'),
+                ('get_archive cold ' + kind,
+                 bench_get_archive(root, url, False), mb, 'MB/s'),
+                ('get_archive warm ' + kind,
+                 bench_get_archive(root, url, True), mb, 'MB/s'),
+            ])
+        benches.append(('build_src serial', bench_serial(root, recipes),
+                        len(recipes), 'pkgs/s'))
+        for executor in args.executors:
+            benches.append(('build_pool ' + executor,
+                            bench_pool(root, recipes, args.jobs, executor),
+                            len(recipes), 'pkgs/s'))
+
+        results = {}
+        for name, prep, amount, unit in benches:
+            try:
+                with quiet(not args.verbose):
+                    wall = timed(prep, args.repeat)
+            except BenchFailed as exc:
+                results[name] = {'failed': str(exc)}
+                print('{:<28} FAILED {}'.format(name, exc))
+                continue
+            results[name] = {'wall': wall, 'rate': amount / wall,
+                             'unit': unit}
+            print('{:<28} {:>8.3f}s {:>10.1f} {}'.format(
+                name, wall, amount / wall, unit))
+            if name.startswith('startup '):
+                results[name]['heavy'] = heavy_imports(name.split()[1])
+                if results[name]['heavy']:
+                    print('  imports up front: ' +
+                          ', '.join(results[name]['heavy']))
+            sys.stdout.flush()
+        return results
+    finally:
+        server.close()
+
+
+def regressions(results, baseline, tolerance):
+    """ Names of benches slower than baseline by more than tolerance,
+        that failed or that import heavy modules at startup.
+    """
+    slower = []
+    for name, res in sorted(results.items()):
+        if res.get('failed'):
+            print('Regression {}: {}'.format(name, res['failed']))
+            slower.append(name)
+            continue
+        if res.get('heavy'):
+            print('Regression {}: imports {}'.format(
+                name, ', '.join(res['heavy'])))
+            slower.append(name)
+            continue
+        old = baseline.get(name)
+        if old and res['wall'] > old['wall'] * (1 + tolerance):
+            print('Regression {}: {:.3f}s -> {:.3f}s'.format(
+                name, old['wall'], res['wall']))
+            slower.append(name)
+    return slower
+
+
+def main():
+    """ Main function. """
+    mesg = """Benchmark BuildSrc.py without network access.
+
+    Generates --packages synthetic recipes of --files files each, archives
+    served by a local http server & local git repos, with fake make cmds
+    taking --cpu seconds of cpu and --sleep seconds of waiting.
+    Every bench runs on fresh caches, the best of --repeat runs is kept.
+    With --baseline a previous --json output gates the run, exit code 1
+    if any bench got slower than --tolerance allows or a tab completed
+    script imports a heavy module at startup. A bench whose builds fail
+    exits 1 with or without a baseline.
+    """
+    parser = argparse.ArgumentParser(description=mesg,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--packages', type=int, default=8,
+                        help='synthetic recipes, default %(default)s')
+    parser.add_argument('--files', type=int, default=200,
+                        help='files per source tree, default %(default)s')
+    parser.add_argument('--file-kb', type=int, default=16,
+                        help='size of each file in KB, default %(default)s')
+    parser.add_argument('--cpu', type=float, default=0.2,
+                        help='cpu seconds per fake make, default %(default)s')
+    parser.add_argument('--sleep', type=float, default=0.2,
+                        help='idle seconds per fake make, '
+                        'default %(default)s')
+    parser.add_argument('--finds', type=int, default=100000,
+                        help='find_archive calls, default %(default)s')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='build_pool jobs, default cpu count')
+    parser.add_argument('-e', '--executors', nargs='+',
+                        default=sorted(BuildSrc.EXECUTORS.keys()),
+                        choices=sorted(BuildSrc.EXECUTORS.keys()),
+                        help='build_pool executors to compare, default all')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per bench, best kept, default %(default)s')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated files')
+    parser.add_argument('--json', default=None,
+                        help='write results to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='json results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown vs baseline, '
+                        'default %(default)s')
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help='keep the scratch dir')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False, help='show output of the builds')
+
+    autocomplete(parser)
+    args = parser.parse_args()  # Default parses argv[1:]
+
+    root = tempfile.mkdtemp(prefix='BenchBuild')
+    try:
+        results = run_benches(args, root)
+    finally:
+        if args.keep:
+            print('Scratch dir kept: ' + root)
+        else:
+            shutil.rmtree(root)
+
+    if args.json:
+        with open(args.json, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            if regressions(results, json.load(fin), args.tolerance):
+                sys.exit(1)
+    if [res for res in results.values() if res.get('failed')]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
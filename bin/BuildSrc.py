@@ -1,22 +1,32 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # PYTHON_ARGCOMPLETE_OK
 """ Build any program I want from source code, deploy locally.
     Depends on wget -- archive downloads, blame SourceForge  --
     and standard c++ build tools.
+    Heavy modules are imported where used, keeps tab completion fast.
 """
 from __future__ import print_function
 import argparse
+import bz2
+import contextlib
+import fcntl
 import functools
 import glob
-import itertools
-import multiprocessing
+import hashlib
+import json
+import lzma
 import os
-import re
+import queue
+import resource
+import select
 import shlex
 import shutil
 import subprocess
-import tarfile
-import zipfile
+import sys
+import threading
+import time
+import zlib
+from collections.abc import Mapping
 try:
     from argcomplete import autocomplete
 except ImportError:
@@ -29,205 +39,74 @@ class WorkerInterrupted(Exception):
     """ Workers handle Exception's easier than intterupts. """
     pass
 
-URL_CMAKE = 'http://www.cmake.org/files/v3.2/cmake-3.2.1.tar.gz'
-URL_GIT = 'https://www.kernel.org/pub/software/scm/git/git-2.5.1.tar.gz'
-URL_PYTHON = 'https://www.python.org/ftp/python/2.7.9/Python-2.7.9.tgz'
-URL_PYTHON3 = 'https://www.python.org/ftp/python/3.4.3/Python-3.4.3.tgz'
-URL_TMUX = 'http://sourceforge.net/projects/tmux/files/tmux/tmux-2.0/' \
-            'tmux-2.0.tar.gz/download?use_mirror=hivelocity'
-URL_ZSH = 'http://sourceforge.net/projects/zsh/files/zsh/5.0.7/' \
-            'zsh-5.0.7.tar.bz2/download'
-
 TMP_DIR = '/tmp/BuildSrc'
-BUILDS = {
-    'ack': {
-        'name': 'ack',
-        'check': 'bin/ack',
-        'url': 'https://github.com/petdance/ack2.git',
-        'cmds': [
-            'perl Makefile.PL',
-            'make ack-standalone',
-            'make manifypods',
-        ],
-        'globs': [
-            ('ack-standalone', 'bin/'),
-            ('ack-standalone', 'bin/ack'),
-            ('blib/man1/*.1*', 'share/man/man1/'),
-        ],
-    },
-    'ag': {
-        'name': 'ag',
-        'check': 'bin/ag',
-        'url': 'https://github.com/ggreer/the_silver_searcher.git',
-        'cmds': [
-            './build.sh --prefix=TARGET',
-            'make install',
-        ],
-    },
-    'atom': {
-        'name': 'atom',
-        'check': 'bin/atom',
-        'url': 'https://github.com/atom/atom',
-        'cmds': [
-            'script/build',
-            'script/grunt install --install-dir TARGET',
-        ],
-    },
-    'cmake': {
-        'name': 'cmake',
-        'check': 'bin/cmake',
-        'url': URL_CMAKE,
-        'cmds': [
-            './bootstrap --prefix=TARGET --docdir=share/doc/cmake-3.0 '
-                    '--mandir=share/man --system-libs '
-                    '--sphinx-man --sphinx-html',
-            'make -jJOBS install',
-        ],
-    },
-    'ctags': {
-        'name': 'ctags',
-        'check': 'bin/ctags',
-        'url': 'https://github.com/fishman/ctags.git',
-        'cmds': [
-            'autoreconf -fiv',
-            './configure --prefix=TARGET',
-            'make install',
-        ],
-    },
-    'doxygen': {
-        'name': 'doxygen',
-        'check': 'bin/doxygen',
-        'url': 'https://github.com/doxygen/doxygen.git',
-        'cmds': [
-            'cmake .',
-            'make -jJOBS',
-        ],
-        'globs': [
-            ('bin/*', 'bin/'),
-            ('doc/*.1', 'share/man/man1/'),
-        ],
-    },
-    'git': {
-        'name': 'git',
-        'check': 'bin/git',
-        'url': URL_GIT,
-        'cmds': [
-            'make configure',
-            './configure --prefix=TARGET',
-            'make -jJOBS',
-            'make install',
-        ],
-    },
-    'neovim': {
-        'name': 'neovim',
-        'check': 'bin/nvim',
-        'url': 'https://github.com/neovim/neovim',
-        'cmds': [
-            'make CMAKE_BUILD_TYPE=RelWithDebInfo '
-                    'CMAKE_EXTRA_FLAGS="-DCMAKE_INSTALL_PREFIX:PATH=TARGET" '
-                    'install',
-        ],
-    },
-    'ninja': {
-        'name': 'ninja',
-        'check': 'bin/ninja',
-        'url': '-b release https://github.com/martine/ninja.git',
-        'cmds': [
-            './configure.py --bootstrap',
-        ],
-        'globs': [
-            ('ninja', 'bin/')
-        ],
-    },
-    'parallel': {
-        'name': 'parallel',
-        'check': 'bin/parallel',
-        'url': 'http://ftp.gnu.org/gnu/parallel/parallel-latest.tar.bz2',
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'python': {
-        'name': 'python',
-        'check': 'bin/python',
-        'url': URL_PYTHON,
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'python3': {
-        'name': 'python3',
-        'check': 'bin/python3',
-        'url': URL_PYTHON3,
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make -jJOBS install',
-        ],
-    },
-    'rethinkdb': {
-        'name': 'rethinkdb',
-        'check': 'bin/rdb',
-        'url': 'http://download.rethinkdb.com/dist/rethinkdb-2.0.1.tgz',
-        'cmds': [
-            './configure --prefix=TARGET --ccache --allow-fetch --fetch curl',
-            'make -jJOBS install',
-        ],
-    },
-    'tmux': {
-        'name': 'tmux',
-        'check': 'bin/tmux',
-        'url': URL_TMUX,
-        'cmds': [
-            './configure --prefix=TARGET',
-            'make install',
-        ],
-    },
-    'vim': {
-        'name': 'vim',
-        'check': 'bin/vim',
-        #'url': 'https://code.google.com/p/vim/',
-        'url': 'https://github.com/vim/vim',
-        'cmds': [
-            './configure --with-features=huge --enable-gui=gtk2 '
-                    '--enable-cscope --enable-multibyte --enable-luainterp '
-                    '--enable-pythoninterp --prefix=TARGET',
-                    'make VIMRUNTIMEDIR=TARGET/share/vim/vim74',
-            'make -jJOBS install',
-        ],
-    },
-    'vimpager': {
-        'name': 'vimpager',
-        'check': 'bin/vimpager',
-        'url': 'https://github.com/rkitover/vimpager.git',
-        'globs': [
-            ('vimcat', 'bin/'),
-            ('vimpager', 'bin/'),
-            ('*.1', 'share/man/man1/'),
-        ],
-    },
-    'zsh': {
-        'name': 'zsh',
-        'check': 'bin/zsh',
-        'url': 'https://github.com/zsh-users/zsh.git',
-        'cmds': [
-            './Util/preconfig',
-            'autoconf',
-            './configure --prefix=TARGET --enable-cap --enable-pcre '
-            '--enable-maildir-support',
-            'make -jJOBS install',
-        ],
-    },
-    'zsh_docs': {
-        'name': 'zsh_docs',
-        'check': 'share/man/man1/zshall.1',
-        'url': URL_ZSH,
-        'globs': [
-            ('Doc/*.1', 'share/man/man1/'),
-        ],
-    },
+# The AsyncExecutor running builds, its event loop owns their children
+ASYNC = None
+# Linux only, elsewhere Telemetry steps see the whole process
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None)
+# Per thread stack of [user, sys, maxrss_kb] totals of the open steps
+STEP_USAGE = threading.local()
+USAGE_LOCK = threading.Lock()
+# Children started by popen & not yet reaped, terminate kills them
+CHILDREN = set()
+CHILDREN_LOCK = threading.Lock()
+# Tar archives that can be extracted while they download
+STREAM_EXTS = ('.tgz', '.tbz2', '.tar.bz2', '.tar.gz', 'tar.xz')
+# Compression by extension, with parallel decompressors to try in order
+COMPRESSIONS = (('.tgz', 'gz'), ('.gz', 'gz'), ('.tbz2', 'bz2'),
+                ('.bz2', 'bz2'), ('.txz', 'xz'), ('.xz', 'xz'))
+DECOMPRESSORS = {
+    'gz': (['pigz', '-dc'], ['gzip', '-dc']),
+    'bz2': (['pbzip2', '-dc'], ['lbzip2', '-dc'], ['bzip2', '-dc']),
+    'xz': (['xz', '-T0', '-dc'],),
+}
+# Tools for archives python can't read
+ARCHIVE_TOOLS = {
+    '.7z': (['7z', 'x', '-y'], ['7za', 'x', '-y'], ['7zr', 'x', '-y']),
+    '.rar': (['unrar', 'x', '-y'], ['rar', 'x', '-y'], ['7z', 'x', '-y']),
 }
+EXTRACT_THREADS = 8
+# Recipes of BuildSrc, one file per build
+RECIPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'recipes')
+# Tweaked by main from the command line, workers inherit on fork.
+SETTINGS = {
+    'cache_dir': os.path.expanduser('~/.cache/BuildSrc'),
+    'cache_size': 2048 * 1024 ** 2,
+    'offline': False,
+    'mirrors': True,
+    'incremental': False,
+    'artifacts': None,
+    'artifacts_size': 4096 * 1024 ** 2,
+    'log': os.path.expanduser('~/.cache/BuildSrc/build.jsonl'),
+    'fetch_jobs': 4,
+    'ccache_size': 5120 * 1024 ** 2,
+    'build_root': None,
+    'retries': 3,
+    'revalidate': 3600,
+}
+# Seconds before the first retry of a fetch, doubles each retry
+RETRY_DELAY = 2
+# Seconds wget gets to exit once its output stopped making a tar
+WGET_EXIT_WAIT = 5
+# Guessing how large source trees grow in the build root
+BUILD_ROOT_RATIO = 8
+BUILD_ROOT_GUESS = 1024 ** 3
+BUILD_ROOT_RESERVE = 512 * 1024 ** 2
+# Compilers routed through ccache when installed & results it logs
+CCACHE_COMPILERS = ('cc', 'c++', 'gcc', 'g++', 'clang', 'clang++')
+CCACHE_HITS = ('direct_cache_hit', 'preprocessed_cache_hit')
+CCACHE_MISSES = ('cache_miss',)
+# Build steps that only configure the tree, skipped on source only changes
+CONFIGURE_PROGS = ('autoconf', 'autogen.sh', 'autoreconf', 'bootstrap',
+                   'bootstrap.sh', 'cmake', 'configure', 'Makefile.PL',
+                   'preconfig')
+# Changes to these files in a repo mean configure must run again
+CONFIGURE_INPUTS = ('CMakeLists.txt', 'Makefile.PL', 'autogen.sh', 'bootstrap',
+                    'configure')
+CONFIGURE_EXTS = ('.ac', '.am', '.cmake', '.in', '.m4')
+# Recipe files, toml ones need tomllib or tomli
+RECIPE_EXTS = ('.json', '.toml')
 
 
 class ArchiveNotSupported(Exception):
@@ -235,24 +114,812 @@ class ArchiveNotSupported(Exception):
     pass
 
 
-class PDir(object):
-    """ Pushd analog for personal use. """
-    dirs = []
+class DependencyCycle(Exception):
+    """ Builds depend on each other, no valid order exists. """
+    pass
+
+
+class ChecksumMismatch(Exception):
+    """ Downloaded file doesn't match the expected sha256. """
+    pass
+
+
+class Offline(Exception):
+    """ Source isn't available locally and network use is disabled. """
+    pass
+
+
+class StepFailed(Exception):
+    """ A build cmd exited with non zero status. """
+    pass
+
+
+class Recipes(Mapping):
+    """ Build recipes, one json or toml file each in rdir, named after the
+        file unless it sets name. Only an index of names to files is read
+        up front, cached in the cache dir until a file in rdir changes.
+        Recipes are parsed when first looked up.
+    """
+    def __init__(self, rdir):
+        self.rdir = rdir
+        self.index = None
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            self.loaded[name] = self.parse(self.names()[name])
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(sorted(self.names()))
+
+    def __len__(self):
+        return len(self.names())
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def names(self):
+        """ Index of recipe names to their files. """
+        if self.index is None:
+            self.index = self.load_index()
+        return self.index
+
+    def stats(self):
+        """ Modification time & size of each recipe file in rdir. """
+        stats = {}
+        for entry in os.scandir(self.rdir):
+            if entry.name.endswith(RECIPE_EXTS) and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = [stat.st_mtime_ns, stat.st_size]
+        return stats
+
+    def index_file(self):
+        """ Where the index of rdir is cached. """
+        key = hashlib.sha256(os.path.abspath(self.rdir).encode('utf-8'))
+        return os.path.join(SETTINGS['cache_dir'], 'recipes',
+                            key.hexdigest()[:16] + '.json')
+
+    def load_index(self):
+        """ Cached index if no file changed, else parse all & recache. """
+        stats = self.stats()
+        cached = self.index_file()
+        try:
+            with open(cached) as fin:
+                index = json.load(fin)
+            if index['files'] == stats:
+                return index['names']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        names = {}
+        for fname in sorted(stats):
+            recipe = self.parse(fname)
+            names[recipe['name']] = fname
+            self.loaded[recipe['name']] = recipe
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            with open(cached + '.tmp', 'w') as fout:
+                json.dump({'files': stats, 'names': names}, fout)
+            os.rename(cached + '.tmp', cached)
+        except (IOError, OSError):
+            pass
+        return names
+
+    def parse(self, fname):
+        """ Read the recipe in fname. """
+        path = os.path.join(self.rdir, fname)
+        if fname.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ImportError('Reading {} needs tomllib or tomli.'
+                                      .format(path))
+            with open(path, 'rb') as fin:
+                recipe = tomllib.load(fin)
+        else:
+            with open(path) as fin:
+                recipe = json.load(fin)
+        recipe.setdefault('name', os.path.splitext(fname)[0])
+        return recipe
+
+
+BUILDS = Recipes(RECIPE_DIR)
+
+
+class ArchiveCache(object):
+    """ Downloaded archives stored under the sha256 of their url.
+        The sha256 of each archive is kept beside it and verified on use.
+        Least recently used archives are evicted beyond max_bytes.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, url):
+        """ Where the archive for url lives in the cache. """
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key + '-' + find_archive(url))
+
+    def lookup(self, url, sha256=None):
+        """ Return path to the cached archive for url or None.
+            Corrupt or mismatched entries are dropped.
+        """
+        path = self.path(url)
+        try:
+            with open(path + '.sha256') as fin:
+                expected = sha256 or fin.read().strip()
+            if file_sha256(path) != expected:
+                raise ChecksumMismatch(path)
+        except (IOError, OSError, ChecksumMismatch):
+            self.remove(path)
+            return None
+
+        os.utime(path, None)
+        return path
+
+    def store(self, url, fname, sha256=None, digest=None):
+        """ Move downloaded fname into the cache, return the new path.
+            An archive bigger than max_bytes is never kept, it is moved
+            to a scratch dir under TMP_DIR instead & that path returned,
+            callers release it once done.
+            digest: sha256 of fname if already known, saves a reread.
+            Raises ChecksumMismatch if fname doesn't match sha256.
+        """
+        digest = digest or file_sha256(fname)
+        if sha256 is not None and digest != sha256:
+            raise ChecksumMismatch('{}: got {} expected {}'.format(
+                url, digest, sha256))
+
+        path = self.path(url)
+        if os.path.getsize(fname) > self.max_bytes:
+            path = os.path.join(TMP_DIR, 'uncached', os.path.basename(path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(fname, path)
+            with open(path + '.sha256', 'w') as fout:
+                fout.write(digest)
+            return path
+
+        tmp_path = '{}.{}.tmp'.format(path, tmp_suffix())
+        shutil.move(fname, tmp_path)
+        with open(path + '.sha256', 'w') as fout:
+            fout.write(digest)
+        os.rename(tmp_path, path)
+        self.evict(keep=path)
+
+        return path
+
+    def release(self, path):
+        """ Delete path if store left it outside the cache. """
+        if os.path.dirname(path) != self.root:
+            self.remove(path)
+
+    def remove(self, path):
+        """ Drop path & its checksum from the cache. """
+        for fname in (path, path + '.sha256'):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """ Remove least recently used archives until under max_bytes.
+            keep: path never removed, the archive just stored.
+        """
+        entries = []
+        for fname in glob.glob(os.path.join(self.root, '*.sha256')):
+            path = fname[:-len('.sha256')]
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                pass
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self.remove(path)
+            total -= size
+
+
+class ArtifactCache(ArchiveCache):
+    """ Installed files of builds as tarballs, stored by build key.
+        Same verification & eviction as the download cache.
+    """
+    def path(self, key):
+        """ Where the artifact for key lives in the cache. """
+        return os.path.join(self.root, key + '.tar.gz')
+
+
+class JobServer(object):
+    """ GNU make compatible jobserver shared by all builds in a pool.
+        A pipe holds one token per job slot. Each running build holds
+        a token for its implicit slot, make reads the rest from the pipe.
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.rfd, self.wfd = os.pipe()
+        os.write(self.wfd, b'+' * jobs)
+
+    def acquire(self):
+        """ Block until a token is free.
+            make >= 4.3 sets O_NONBLOCK on the shared pipe, so wait on it
+            with select & retry when another reader won the token.
+        """
+        while True:
+            try:
+                if os.read(self.rfd, 1):
+                    return
+            except BlockingIOError:
+                pass
+            select.select([self.rfd], [], [])
+
+    def release(self):
+        """ Return a token to the pipe. """
+        os.write(self.wfd, b'+')
+
+    def env(self, base=None):
+        """ Environment for make to join this jobserver, base defaults
+            to os.environ. """
+        env = (base or os.environ).copy()
+        env['MAKEFLAGS'] = '-j{} --jobserver-auth={},{}'.format(
+            self.jobs, self.rfd, self.wfd)
+        return env
+
+    def close(self):
+        """ Close the pipe, only once all builds are done. """
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class MirrorStore(object):
+    """ Local bare git mirrors & hg clones without working copy.
+        Mirrors are fetched incrementally, checkouts are cloned from them
+        with hardlinks so only new history crosses the network.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, url):
+        """ Where the mirror of url lives. """
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        name = url.rstrip('/').split('/')[-1] or 'repo'
+        return os.path.join(self.root, key + '-' + name)
+
+    def update(self, kind, url):
+        """ Create or fetch the mirror of url, return its path.
+            Offline an existing mirror is used as is.
+        """
+        path = self.path(url)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exists = os.path.exists(path)
+            if SETTINGS['offline']:
+                if not exists:
+                    raise Offline('Repository not mirrored: ' + url)
+                return path
+
+            if kind == 'git' and exists:
+                cmd = ['git', 'fetch', '--prune', 'origin']
+            elif kind == 'git':
+                cmd = ['git', 'clone', '--mirror', url, path]
+            elif exists:
+                cmd = ['hg', 'pull']
+            else:
+                cmd = ['hg', 'clone', '-U', url, path]
+
+            def fetch():
+                """ Partial clones would look like mirrors, remove them. """
+                try:
+                    check_call(cmd, cwd=path if exists else None)
+                except subprocess.CalledProcessError:
+                    if not exists and os.path.exists(path):
+                        shutil.rmtree(path)
+                    raise
+
+            try:
+                with_retries(fetch, url)
+            except subprocess.CalledProcessError:
+                if not exists:
+                    raise
+                print('Failed to update mirror, using stale: ' + path)
+
+        return path
+
+    def checkout(self, kind, url, opts, target):
+        """ Clone the mirror of url to target, origin points back at url.
+            opts: extra clone args, like ['-b', 'release'].
+        """
+        mirror = self.update(kind, url)
+        try:
+            if kind == 'git':
+                check_call(['git', 'clone'] + opts + [mirror, target])
+                check_call(['git', 'remote', 'set-url', 'origin', url],
+                           cwd=target)
+                if call(['git', 'submodule', 'update', '--init',
+                         '--recursive'], cwd=target) != 0:
+                    print('Failed to update submodules: ' + target)
+            else:
+                check_call(['hg', 'clone'] + opts + [mirror, target])
+                with open(os.path.join(target, '.hg', 'hgrc'), 'w') as fout:
+                    fout.write('[paths]\ndefault = {}\n'.format(url))
+        except (subprocess.CalledProcessError, OSError, IOError):
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            raise
+
+
+class TeeReader(object):
+    """ File like reader, copies everything read to fout & hashes it. """
+    def __init__(self, fin, fout=None):
+        self.fin = fin
+        self.fout = fout
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        """ Read from fin, pass data along to fout. """
+        data = self.fin.read(size)
+        self.digest.update(data)
+        if self.fout is not None:
+            self.fout.write(data)
+        return data
+
+    def drain(self):
+        """ Consume the rest of fin, tar stops before trailing padding. """
+        while self.read(1024 ** 2):
+            pass
+
+
+class ChunkedDecompressor(object):
+    """ File like reader decompressing fin a chunk at a time in a thread.
+        zlib, bz2 & lzma release the GIL so this overlaps with tar writes.
+        Handles concatenated streams, like pbzip2 & pigz output.
+    """
+    def __init__(self, fin, kind, chunk=1024 ** 2):
+        self.chunks = queue.Queue(16)
+        self.buf = b''
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=counted(self.decompress),
+                                       args=(fin, kind, chunk))
+        self.thread.daemon = True
+        self.thread.start()
 
     @staticmethod
-    def push(new_dir):
-        """ Push curdir to stack and change to new_dir. """
-        curdir = os.path.abspath(os.curdir)
-        PDir.dirs.append(curdir)
-        os.chdir(new_dir)
-        print("%s >>> %s" % (curdir, new_dir))
+    def decompressor(kind):
+        """ New decompressor object for kind of compression. """
+        if kind == 'gz':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif kind == 'bz2':
+            return bz2.BZ2Decompressor()
+        return lzma.LZMADecompressor()
+
+    def decompress(self, fin, kind, chunk):
+        """ Thread body, feeds decompressed chunks to the queue. """
+        try:
+            dec = self.decompressor(kind)
+            for data in iter(lambda: fin.read(chunk), b''):
+                while data:
+                    out = dec.decompress(data)
+                    if out:
+                        self.put(out)
+                    data = b''
+                    if dec.eof:
+                        data = dec.unused_data
+                        dec = self.decompressor(kind)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.error = exc
+        finally:
+            self.put(None)
+
+    def put(self, chunk):
+        """ Queue chunk, gives up once the reader is closed. """
+        while not self.closed:
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        """ Stop the thread early, nobody will read the rest. """
+        self.closed = True
+
+    def read(self, size=-1):
+        """ Read up to size decompressed bytes, all if size < 0. """
+        while not self.done and (size < 0 or len(self.buf) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.done = True
+                if self.error is not None:
+                    raise self.error
+            else:
+                self.buf += chunk
+
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def open_steps():
+    """ Usage totals of the Telemetry steps open in this thread. """
+    return getattr(STEP_USAGE, 'stack', [])
+
+
+def count_usage(user, sys_time, maxrss, steps=None):
+    """ Charge cpu this thread's rusage misses, reaped children & helper
+        threads, to steps, by default the steps open in this thread.
+    """
+    with USAGE_LOCK:
+        for totals in open_steps() if steps is None else steps:
+            totals[0] += user
+            totals[1] += sys_time
+            totals[2] = max(totals[2], maxrss)
+
+
+def counted(func):
+    """ Wrap func for a helper thread, its cpu is charged to the steps
+        open in the thread that wrapped it.
+    """
+    steps = list(open_steps())
+    if RUSAGE_THREAD is None or not steps:
+        return func
+
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        """ Measure func in this thread. """
+        before = resource.getrusage(RUSAGE_THREAD)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            after = resource.getrusage(RUSAGE_THREAD)
+            count_usage(after.ru_utime - before.ru_utime,
+                        after.ru_stime - before.ru_stime, 0, steps)
+    return inner
+
+
+def reap(proc, timeout=None):
+    """ proc.wait() through wait4, the child's cpu goes to the open steps.
+        With a timeout returns None if proc is still running after it.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while proc.returncode is None:
+        try:
+            pid, status, usage = os.wait4(
+                proc.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            # The poll in a kill got it first, its rusage is lost
+            proc.wait()
+            break
+        if pid == 0:
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.01)
+            continue
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        count_usage(usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+    with CHILDREN_LOCK:
+        CHILDREN.discard(proc)
+    return proc.returncode
+
+
+class Telemetry(object):
+    """ Times every step of a build with cpu & peak memory use.
+        Each step is kept in records and appended as a json line to log.
+    """
+    def __init__(self, name, log=None):
+        self.name = name
+        self.log = log
+        self.records = []
+
+    def record(self, kind, detail, start, usage, code):
+        """ Keep a step, usage is (user, sys, maxrss_kb). """
+        rec = {
+            'build': self.name,
+            'step': kind,
+            'detail': detail,
+            'start': start,
+            'wall': time.time() - start,
+            'user': usage[0],
+            'sys': usage[1],
+            'maxrss_kb': usage[2],
+            'code': code,
+        }
+        self.records.append(rec)
+        if self.log:
+            os.makedirs(os.path.dirname(self.log), exist_ok=True)
+            with open(self.log, 'a') as fout:
+                fout.write(json.dumps(rec, sort_keys=True) + '\n')
 
     @staticmethod
-    def pop():
-        """ Pop the dirstack and return to it. """
-        old_dir = PDir.dirs.pop()
-        os.chdir(old_dir)
-        print(">>> %s" % old_dir)
+    def usage():
+        """ Cpu seconds & peak rss of this thread. Without RUSAGE_THREAD
+            of the whole process and its children, concurrent builds blur.
+        """
+        if RUSAGE_THREAD is not None:
+            mine = resource.getrusage(RUSAGE_THREAD)
+            return mine.ru_utime, mine.ru_stime, mine.ru_maxrss
+        mine = resource.getrusage(resource.RUSAGE_SELF)
+        kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (mine.ru_utime + kids.ru_utime, mine.ru_stime + kids.ru_stime,
+                max(mine.ru_maxrss, kids.ru_maxrss))
+
+    @contextlib.contextmanager
+    def step(self, kind, detail=''):
+        """ Measure the python work in this thread & the children reaped
+            and helper threads counted in the with block.
+        """
+        totals = [0.0, 0.0, 0]
+        stack = open_steps()
+        STEP_USAGE.stack = stack + [totals]
+        start, before, code = time.time(), self.usage(), 0
+        try:
+            yield
+        except BaseException:
+            code = 1
+            raise
+        finally:
+            after = self.usage()
+            STEP_USAGE.stack = stack
+            with USAGE_LOCK:
+                extra = list(totals)
+            self.record(kind, detail, start, (after[0] - before[0] + extra[0],
+                                              after[1] - before[1] + extra[1],
+                                              max(after[2], extra[2])), code)
+
+    def run(self, args, **kwargs):
+        """ call that measures the cmd, cpu & rss come from wait4.
+            Under the async executor only wall time is known.
+        """
+        start = time.time()
+        code, usage = spawn(args, **kwargs)
+        if usage is None:
+            usage = (None, None, None)
+        else:
+            usage = (usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+        self.record('cmd', ' '.join(args), start, usage, code)
+
+        return code
+
+
+class ProcessExecutor(object):
+    """ Builds run in a pool of worker processes. """
+    def __init__(self, workers):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(workers)
+
+    def submit(self, func, args, done):
+        """ Run func(args) in the pool, then done(result, exception). """
+        self.pool.apply_async(func, (args,),
+                              callback=lambda res: done(res, None),
+                              error_callback=lambda exc: done(None, exc))
+
+    def close(self):
+        """ Wait for submitted work to finish. """
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """ Abandon all work immediately. """
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ThreadExecutor(ProcessExecutor):
+    """ Builds run in a pool of threads, they mostly wait on children. """
+    def __init__(self, workers):  # pylint: disable=super-init-not-called
+        import multiprocessing.pool
+        self.pool = multiprocessing.pool.ThreadPool(workers)
+
+
+class AsyncExecutor(object):
+    """ An event loop in a thread owns the cmd & fetch children of the
+        builds, awaited through asyncio.create_subprocess_exec.
+        Children whose pipes python reads, streamed wget, decompressors &
+        revision queries, come from popen instead.
+        The python side of each build runs on a light thread.
+        Terminating cancels the loop's children, kills popen's, then lets
+        builds unwind.
+    """
+    def __init__(self, workers):
+        global ASYNC
+        import asyncio
+        import concurrent.futures
+        self.closing = False
+        self.loop = asyncio.new_event_loop()
+        self.threads = concurrent.futures.ThreadPoolExecutor(workers)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        ASYNC = self
+
+    async def run(self, func, args):
+        """ Coroutine running func(args) on a build thread. """
+        return await self.loop.run_in_executor(self.threads, func, args)
+
+    async def run_child(self, args, **kwargs):
+        """ Coroutine running a child to completion, killed on cancel. """
+        import asyncio
+        proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+        try:
+            return await proc.wait()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+    def spawn(self, args, **kwargs):
+        """ Called from build threads, blocks until the child exits. """
+        import asyncio
+        import concurrent.futures
+        if self.closing:
+            raise concurrent.futures.CancelledError()
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_child(args, **kwargs), self.loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                # Don't hang on a child the loop lost track of
+                if self.closing:
+                    future.cancel()
+
+    def submit(self, func, args, done):
+        """ Run func(args) on the loop, then done(result, exception). """
+        import asyncio
+        import concurrent.futures
+
+        def finish(future):
+            """ Unpack the future for done. """
+            if future.cancelled():
+                done(None, concurrent.futures.CancelledError())
+            elif future.exception() is not None:
+                done(None, future.exception())
+            else:
+                done(future.result(), None)
+
+        asyncio.run_coroutine_threadsafe(
+            self.run(func, args), self.loop).add_done_callback(finish)
+
+    def cancel_all(self):
+        """ Cancel every task on the loop, killing running children. """
+        import asyncio
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+
+    def stop(self):
+        """ Stop the loop once build threads are done. """
+        global ASYNC
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        ASYNC = None
+
+    def close(self):
+        """ Wait for submitted work to finish. """
+        self.threads.shutdown(wait=True)
+        self.stop()
+
+    def terminate(self):
+        """ Kill running children, drop queued builds & wait to unwind. """
+        self.closing = True
+        self.loop.call_soon_threadsafe(self.cancel_all)
+        kill_children()
+        self.threads.shutdown(wait=True, cancel_futures=True)
+        self.stop()
+
+
+EXECUTORS = {
+    'async': AsyncExecutor,
+    'process': ProcessExecutor,
+    'thread': ThreadExecutor,
+}
+
+
+def spawn(args, **kwargs):
+    """ Run args to completion, return (exit code, rusage or None).
+        Under the async executor the event loop owns the child.
+    """
+    executor = ASYNC
+    if executor is not None:
+        return executor.spawn(args, **kwargs), None
+
+    proc = subprocess.Popen(args, **kwargs)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    count_usage(usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+
+    return proc.returncode, usage
+
+
+def popen(args, **kwargs):
+    """ subprocess.Popen for children whose pipes python reads, the
+        caller must reap them. Until then kill_children can kill them,
+        refuses to start one once the async executor is terminating.
+    """
+    import concurrent.futures
+    proc = subprocess.Popen(args, **kwargs)
+    with CHILDREN_LOCK:
+        CHILDREN.add(proc)
+    executor = ASYNC
+    if executor is not None and executor.closing:
+        proc.kill()
+        reap(proc)
+        raise concurrent.futures.CancelledError()
+    return proc
+
+
+def kill_children():
+    """ Kill the children popen started that still run. """
+    with CHILDREN_LOCK:
+        procs = list(CHILDREN)
+    for proc in procs:
+        if proc.returncode is None:
+            proc.kill()
+
+
+def communicate(args, timeout=None, **kwargs):
+    """ Run args through popen, return (exit code, stdout, stderr).
+        Raises subprocess.TimeoutExpired after timeout seconds.
+    """
+    proc = popen(args, **kwargs)
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+        reap(proc)
+    return proc.returncode, out, err
+
+
+def check_output(args, **kwargs):
+    """ subprocess.check_output that goes through popen. """
+    code, out, _ = communicate(args, stdout=subprocess.PIPE, **kwargs)
+    if code != 0:
+        raise subprocess.CalledProcessError(code, args, out)
+    return out
+
+
+def call(args, **kwargs):
+    """ subprocess.call that goes through spawn. """
+    return spawn(args, **kwargs)[0]
+
+
+def check_call(args, **kwargs):
+    """ subprocess.check_call that goes through spawn. """
+    code = call(args, **kwargs)
+    if code != 0:
+        raise subprocess.CalledProcessError(code, args)
+
+
+def tmp_suffix():
+    """ Unique to this process & thread, names scratch files beside shared
+        ones so concurrent fetches of one url don't collide. """
+    return '{}.{}'.format(os.getpid(), threading.get_ident())
+
+
+def file_sha256(fname):
+    """ Hex sha256 of a file, read in chunks. """
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1024 ** 2), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def find_archive(url):
@@ -274,106 +941,648 @@ def find_archive(url):
     return url[left:right]
 
 
-def extract_archive(archive):
-    """ Given an archive, extract it. Prefer python libs if supported. """
-    if tarfile.is_tarfile(archive):
-        tarf = tarfile.open(archive)
-        tarf.extractall()
+def compression_of(name):
+    """ Kind of compression name uses going by extension, None if unknown. """
+    for ext, kind in COMPRESSIONS:
+        if name.endswith(ext):
+            return kind
+    return None
+
+
+def find_tool(candidates):
+    """ First cmd in candidates whose program is on the PATH, else None. """
+    for cmd in candidates:
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+
+@contextlib.contextmanager
+def decompressed(fin, kind):
+    """ Yield a reader of fin decompressed, preferring a parallel tool
+        like pigz or xz -T0, else decompressing in chunks in a thread.
+        fin is consumed to the end on exit.
+    """
+    if kind is None:
+        yield fin
+        return
+
+    cmd = find_tool(DECOMPRESSORS[kind])
+    if cmd is None:
+        reader = ChunkedDecompressor(fin, kind)
+        try:
+            yield reader
+            while reader.read(1024 ** 2):
+                pass
+        finally:
+            reader.close()
+        return
+
+    try:
+        fin.fileno()
+        proc = popen(cmd, stdin=fin, stdout=subprocess.PIPE)
+        feeder = None
+    except (AttributeError, IOError, ValueError):
+        proc = popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        feeder = threading.Thread(target=counted(feed_pipe),
+                                  args=(fin, proc.stdin))
+        feeder.daemon = True
+        feeder.start()
+
+    try:
+        yield proc.stdout
+        while proc.stdout.read(1024 ** 2):
+            pass
+        if reap(proc) != 0:
+            raise IOError('Failed to decompress with: ' + ' '.join(cmd))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            reap(proc)
+        proc.stdout.close()
+        if feeder is not None:
+            feeder.join()
+
+
+def feed_pipe(fin, pipe):
+    """ Copy fin into pipe until either ends, then close pipe. """
+    try:
+        for data in iter(lambda: fin.read(1024 ** 2), b''):
+            pipe.write(data)
+    except (IOError, OSError, ValueError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
+
+
+def safe_path(dest, name):
+    """ Path of archive member name under dest, None if it escapes dest. """
+    dest = os.path.abspath(dest)
+    path = os.path.normpath(os.path.join(dest, name))
+    if os.path.isabs(name) or not path.startswith(dest + os.sep):
+        return None
+    return path
+
+
+def write_member(path, data, mode, mtime):
+    """ Write a regular file extracted from a tar. """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    with open(path, 'wb') as fout:
+        fout.write(data)
+    os.chmod(path, mode & 0o7777)
+    os.utime(path, (mtime, mtime))
+
+
+def untar(fin, dest, threads=EXTRACT_THREADS):
+    """ Extract the tar stream fin into dest.
+        Regular files are written by a pool of threads while the stream
+        is read, links & directory modes are applied once files are done.
+        Members that would land outside dest are skipped.
+    """
+    import multiprocessing.pool
+    import tarfile
+    pool = multiprocessing.pool.ThreadPool(threads)
+    slots = threading.BoundedSemaphore(threads * 4)
+    write = counted(write_member)
+    results, links, dirs = [], [], []
+    try:
+        with tarfile.open(fileobj=fin, mode='r|*') as tarf:
+            for member in tarf:
+                path = safe_path(dest, member.name)
+                if path is None:
+                    continue
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    dirs.append((path, member))
+                elif member.isreg():
+                    data = tarf.extractfile(member).read()
+                    slots.acquire()
+                    results.append(pool.apply_async(
+                        write, (path, data, member.mode, member.mtime),
+                        callback=lambda _: slots.release(),
+                        error_callback=lambda _: slots.release()))
+                elif member.issym() or member.islnk():
+                    links.append((path, member))
+        pool.close()
+        for result in results:
+            result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for path, member in links:
+        if os.path.lexists(path):
+            os.remove(path)
+        if member.issym():
+            os.symlink(member.linkname, path)
+        else:
+            source = safe_path(dest, member.linkname)
+            if source is not None:
+                try:
+                    os.link(source, path)
+                except OSError:
+                    shutil.copy2(source, path)
+
+    for path, member in reversed(dirs):
+        os.chmod(path, member.mode & 0o7777)
+        os.utime(path, (member.mtime, member.mtime))
+
+
+def unzip(archive, dest, threads=EXTRACT_THREADS):
+    """ Extract a zip file into dest, members in parallel. """
+    import multiprocessing.pool
+    import zipfile
+    zipf = zipfile.ZipFile(archive)
+    names = zipf.namelist()
+    for name in names:
+        if name.endswith('/'):
+            zipf.extract(name, dest)
+        else:
+            parent = os.path.dirname(name)
+            if parent:
+                os.makedirs(os.path.join(dest, parent), exist_ok=True)
+
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        pool.map(counted(lambda name: zipf.extract(name, dest)),
+                 [name for name in names if not name.endswith('/')])
+    finally:
+        pool.close()
+        pool.join()
+        zipf.close()
+
+
+def extract_archive(archive, dest=os.curdir):
+    """ Given an archive, extract it into dest.
+        Tars are decompressed by parallel tools when present & written
+        by a thread pool. 7z & rar use local tools, anything else falls
+        back to the unarchive script.
+    """
+    import tarfile
+    import zipfile
+    archive = os.path.abspath(archive)
+    tool = None
+    for ext, candidates in ARCHIVE_TOOLS.items():
+        if archive.endswith(ext):
+            tool = find_tool(candidates)
+            if tool is None:
+                raise OSError('Install one of: ' + ', '.join(
+                    cmd[0] for cmd in candidates))
+
+    if tool is not None:
+        if call(tool + [archive], cwd=dest) != 0:
+            raise OSError('Failed to extract: ' + archive)
+    elif tarfile.is_tarfile(archive):
+        with open(archive, 'rb') as fin:
+            with decompressed(fin, compression_of(archive)) as tarin:
+                untar(tarin, dest)
     elif zipfile.is_zipfile(archive):
-        zipf = zipfile.ZipFile(archive)
-        zipf.extractall()
+        unzip(archive, dest)
     else:
-        # Fall back to shell tools to extract
-        unarc_src = 'https://raw.githubusercontent.com/starcraftman/' \
-                    '.my_scripts/master/unarchive'
-        cmds = ['curl -o una ' + unarc_src, 'bash ./una ' + archive]
+        # Fall back to shell tools to extract, prefer copy beside this file
+        local = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'unarchive')
+        if os.path.exists(local):
+            cmds = ['bash {} {}'.format(local, archive)]
+        else:
+            unarc_src = 'https://raw.githubusercontent.com/starcraftman/' \
+                        '.my_scripts/master/unarchive'
+            cmds = ['curl -o una ' + unarc_src, 'bash ./una ' + archive]
         for cmd in cmds:
-            proc = subprocess.Popen(shlex.split(cmd))
-            proc.wait()
-            if proc.returncode != 0:
+            if call(shlex.split(cmd), cwd=dest) != 0:
                 raise OSError('Some shell util like curl unavailable.')
-        os.remove('una')
+        if os.path.exists(os.path.join(dest, 'una')):
+            os.remove(os.path.join(dest, 'una'))
 
 
-def get_archive(url, target):
-    """ Fetch an archive from a site. Works on regular ftp & sourceforge.
-    Wish sourceforge wasn't a pain...
+def download_cache():
+    """ The download cache configured in SETTINGS. """
+    return ArchiveCache(SETTINGS['cache_dir'] + os.sep + 'archives',
+                        SETTINGS['cache_size'])
+
+
+def remote_modified(url):
+    """ Last-Modified of url as a timestamp, None if the server won't say. """
+    import email.utils
+    try:
+        _, _, out = communicate(['wget', '-S', '--spider', '-q', url],
+                                timeout=60, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+    # Headers of every redirect are printed, the last one counts
+    stamps = [line.split(':', 1)[1].strip() for line in
+              out.decode('utf-8', 'replace').splitlines()
+              if line.strip().lower().startswith('last-modified:')]
+    try:
+        return email.utils.parsedate_to_datetime(stamps[-1]).timestamp()
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def cached_archive(url, sha256=None):
+    """ Path to the archive of url in the download cache or None.
+        Without a sha256 the url may move, like foo-latest.tar.gz, so an
+        entry stored over SETTINGS['revalidate'] seconds ago is checked
+        against the server's Last-Modified & dropped if newer or unknown.
+    """
+    cache = download_cache()
+    archive = cache.lookup(url, sha256)
+    if archive is None or sha256 is not None or SETTINGS['offline']:
+        return archive
+
+    stored = os.path.getmtime(archive + '.sha256')
+    if time.time() - stored < SETTINGS['revalidate']:
+        return archive
+    modified = remote_modified(url)
+    if modified is not None and modified <= stored:
+        os.utime(archive + '.sha256', None)
+        return archive
+
+    cache.remove(archive)
+    return None
+
+
+def fetch_archive(url, sha256=None):
+    """ Return path to the archive of url in the download cache.
+    Fetches on a miss, using wget because of sourceforge corner case.
 
     url: location to get archive
-    target: where to extract to
+    sha256: optional expected hex digest of the archive
     """
     arc_name = find_archive(url)
+    cache = download_cache()
+    archive = cached_archive(url, sha256)
+    if archive is not None:
+        return archive
+    if SETTINGS['offline']:
+        raise Offline('Archive not cached: ' + url)
 
-    tmp_file = TMP_DIR + os.path.sep + arc_name
-    if not os.path.exists(TMP_DIR):
-        os.makedirs(TMP_DIR)
+    tmp_file = os.path.join(TMP_DIR, tmp_suffix() + '-' + arc_name)
+    os.makedirs(TMP_DIR, exist_ok=True)
 
-    if not os.path.exists(target):
-        os.makedirs(target)
-        os.rmdir(target)
+    def download():
+        """ Fetch url to tmp_file. """
+        cmd = 'wget -O %s %s' % (tmp_file, url)
+        if call(shlex.split(cmd)) != 0:
+            raise IOError('Failed to download: ' + url)
 
     try:
-        # Using wget because of sourceforge corner case
-        cmd = 'wget -O %s %s' % (tmp_file, url)
-        subprocess.call(shlex.split(cmd))
+        with_retries(download, url)
+        return cache.store(url, tmp_file, sha256)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+@contextlib.contextmanager
+def fetched_archive(url, sha256=None):
+    """ Yield fetch_archive(url, sha256), an archive too big for the
+        download cache is deleted when the with block exits.
+    """
+    archive = fetch_archive(url, sha256)
+    try:
+        yield archive
+    finally:
+        download_cache().release(archive)
 
-        extract_archive(tmp_file)
 
-        # Infer target dir by chopping off target right most folder
-        target_r_index = target.rfind(os.path.sep, 0, len(target) - 2)
-        target_dir = target[0:target_r_index]
+def prepare_extract(target):
+    """ Make a fresh dir beside target to extract into, return it. """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_dir = target + '.part'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
 
-        # extracted dir doesn't always match arc_name, glob to be sure
-        arc_front = re.split('[-_]', arc_name)[0] + '*'
-        extracted = None
-        for name in glob.glob(arc_front):
-            if name not in [arc_name, target_dir]:
-                extracted = name
+    return tmp_dir
 
-        os.rename(extracted, target)
+
+def move_extracted(tmp_dir, target):
+    """ Move what an archive extracted into tmp_dir to target.
+        Archives usually hold one folder, that becomes target.
+    """
+    names = os.listdir(tmp_dir)
+    top = os.path.join(tmp_dir, names[0]) if len(names) == 1 else None
+    if top and os.path.isdir(top) and not os.path.islink(top):
+        os.rename(top, target)
+        os.rmdir(tmp_dir)
+    else:
+        os.rename(tmp_dir, target)
+
+
+def extract_to(archive, target):
+    """ Extract archive and move the folder it contains to target.
+
+    archive: absolute path to the archive
+    target: where to extract to
+    """
+    tmp_dir = prepare_extract(target)
+    try:
+        extract_archive(archive, tmp_dir)
+        move_extracted(tmp_dir, target)
     finally:
-        if os.path.exists(tmp_file):
-            os.remove(tmp_file)
-        if os.path.exists(extracted):
-            shutil.rmtree(extracted)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def stream_archive(url, target, sha256=None):
+    """ Pipe the download of a tar archive straight into tarfile,
+    extracting to target while it arrives. The archive is copied into
+    the download cache on the way past, unless the cache size is 0.
+
+    url: location to get archive
+    target: where to extract to
+    sha256: optional expected hex digest of the archive
+    """
+    import tarfile
+    if SETTINGS['offline']:
+        raise Offline('Archive not cached: ' + url)
+
+    cache = download_cache()
+    part = None
+    if cache.max_bytes > 0:
+        part = '{}.{}.part'.format(cache.path(url), tmp_suffix())
+
+    tmp_dir = prepare_extract(target)
+    fout = open(part, 'wb') if part else None
+    proc = popen(['wget', '-O', '-', url], stdout=subprocess.PIPE)
+    try:
+        reader = TeeReader(proc.stdout, fout)
+        try:
+            with decompressed(reader, compression_of(find_archive(url))) \
+                    as tarin:
+                untar(tarin, tmp_dir)
+            reader.drain()
+        except tarfile.TarError:
+            # An http error ends wget's output at once, so wait for it to
+            # exit & blame it. A big non tar body would block it forever.
+            if reap(proc, WGET_EXIT_WAIT) is None:
+                proc.kill()
+                reap(proc)
+            elif proc.returncode != 0:
+                raise IOError('Failed to download: ' + url)
+            raise
+        if reap(proc) != 0:
+            raise IOError('Failed to download: ' + url)
+
+        digest = reader.digest.hexdigest()
+        if sha256 is not None and digest != sha256:
+            raise ChecksumMismatch('{}: got {} expected {}'.format(
+                url, digest, sha256))
+        # Cache first, a failure then leaves target untouched for a retry
+        if fout is not None:
+            fout.close()
+            cache.store(url, part, digest=digest)
+        move_extracted(tmp_dir, target)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            reap(proc)
+        proc.stdout.close()
+        if fout is not None:
+            fout.close()
+        if part and os.path.exists(part):
+            os.remove(part)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def get_archive(url, target, sha256=None, tele=None):
+    """ Fetch an archive from a site. Works on regular ftp & sourceforge.
+    Wish sourceforge wasn't a pain...
+    Archives are kept in the download cache, only fetched on a miss.
+    Tar archives missing from the cache are extracted as they download.
+
+    url: location to get archive
+    target: where to extract to
+    sha256: optional expected hex digest of the archive
+    tele: Telemetry to time the fetch & extract steps
+    """
+    tele = tele or Telemetry(None)
+    arc_name = find_archive(url)
+    archive = cached_archive(url, sha256)
+    if archive is None and arc_name.endswith(STREAM_EXTS):
+        with tele.step('fetch+extract', url):
+            with_retries(lambda: stream_archive(url, target, sha256), url)
+        return
+
+    if archive is not None:
+        with tele.step('extract', archive):
+            extract_to(archive, target)
+        return
+
+    with contextlib.ExitStack() as stack:
+        with tele.step('fetch', url):
+            archive = stack.enter_context(fetched_archive(url, sha256))
+        with tele.step('extract', archive):
+            extract_to(archive, target)
+
+
+def with_retries(func, what):
+    """ Return func(), calling it again up to SETTINGS['retries'] times
+        on network like failures. Waits RETRY_DELAY seconds before the
+        first retry, doubling each time.
+        Children killed by a terminating executor aren't retried.
+        what: named in messages about retries.
+    """
+    delay = RETRY_DELAY
+    for attempt in range(SETTINGS['retries'] + 1):
+        try:
+            return func()
+        except (subprocess.CalledProcessError, OSError, IOError) as exc:
+            executor = ASYNC
+            if attempt == SETTINGS['retries'] or (
+                    executor is not None and executor.closing):
+                raise
+            print('Retrying {} in {}s: {}'.format(what, delay, exc))
+            time.sleep(delay)
+            delay *= 2
+
+
+def vcs_kind(url):
+    """ Guess the version control system from the url. """
+    # Git urls always end in .git
+    if url.find('git') != -1:
+        return 'git'
+    # svn always at front of proto
+    elif url.find('svn') != -1:
+        return 'svn'
+    return 'hg'
 
 
 def get_code(url, target):
     """ Wrapper function to clone repos, only executes if target doesn't exist
-    url: The origin to clone
+    Git & hg repos are cloned from a local mirror updated incrementally,
+    falling back to a direct clone if the mirror fails.
+
+    url: The origin to clone, may be prefixed by clone options
     target: Where to clone to
     """
+    if os.path.exists(target):
+        return
+
+    kind = vcs_kind(url)
+    if kind != 'svn' and SETTINGS['mirrors']:
+        args = shlex.split(url)
+        mirrors = MirrorStore(SETTINGS['cache_dir'] + os.sep + 'mirrors')
+        try:
+            mirrors.checkout(kind, args[-1], args[:-1], target)
+            return
+        except (subprocess.CalledProcessError, OSError, IOError) as exc:
+            print('Mirror clone failed for {}: {}'.format(url, exc))
+
+    if SETTINGS['offline']:
+        raise Offline('Repository needs network: ' + url)
+
     cmd = ' %s %s' % (url, target)
-    retry = None
-    # Git urls always end in .git
-    if url.find('git') != -1:
+    if kind == 'git':
         cmd = 'git clone --recursive --depth 1' + cmd
-        retry = lambda: subprocess.call(shlex.split(
-            cmd.replace('git', '/usr/bin/git', 1)))
-    # svn always at front of proto
-    elif url.find('svn') != -1:
+    elif kind == 'svn':
         cmd = 'svn checkout' + cmd
     else:
         cmd = 'hg clone' + cmd
 
-    if not os.path.exists(target):
-        ret = subprocess.call(shlex.split(cmd))
-        if retry and ret != 0:
-            retry()
+    def clone():
+        """ Clone, removing what a failed attempt left behind. """
+        try:
+            check_call(shlex.split(cmd))
+        except subprocess.CalledProcessError:
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            raise
+
+    with_retries(clone, url)
+
 
+def update_code(url, target):
+    """ Bring an existing checkout at target up to date with its origin.
+        Returns False if a step failed.
+    """
+    if SETTINGS['offline']:
+        return True
+
+    kind = vcs_kind(url)
+    if kind == 'git':
+        cmds = [['git', 'pull', '--ff-only'],
+                ['git', 'submodule', 'update', '--init', '--recursive']]
+    elif kind == 'svn':
+        cmds = [['svn', 'update']]
+    else:
+        cmds = [['hg', 'pull', '-u']]
 
+    for cmd in cmds:
+        if call(cmd, cwd=target) != 0:
+            print('Failed to update {}: {}'.format(target, ' '.join(cmd)))
+            return False
+    return True
 
-def build_src(build, target=None):
+
+def code_revision(url, target):
+    """ Revision currently checked out at target. """
+    kind = vcs_kind(url)
+    if kind == 'git':
+        cmd = ['git', 'rev-parse', 'HEAD']
+    elif kind == 'svn':
+        cmd = ['svnversion']
+    else:
+        cmd = ['hg', 'id', '-i']
+
+    return check_output(cmd, cwd=target).decode().strip()
+
+
+def changed_files(url, target, old, new):
+    """ Files changed between two revisions of checkout at target.
+        Returns None when they can't be listed.
+    """
+    if vcs_kind(url) != 'git':
+        return None
+    try:
+        out = check_output(['git', 'diff', '--name-only', old, new],
+                           cwd=target)
+        return out.decode().split()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def configure_changed(changed):
+    """ True if any changed file could alter the result of configure. """
+    if changed is None:
+        return True
+    for fname in changed:
+        base = os.path.basename(fname)
+        if base in CONFIGURE_INPUTS or base.endswith(CONFIGURE_EXTS):
+            return True
+    return False
+
+
+def is_configure(cmd):
+    """ True if cmd only configures the tree, like ./configure or cmake . """
+    args = shlex.split(cmd)
+    if args[0] in ('bash', 'perl', 'sh') and len(args) > 1:
+        args = args[1:]
+    prog = os.path.basename(args[0])
+    if prog == 'make':
+        return args[1:] == ['configure']
+    if prog == 'cmake':
+        return '--build' not in args
+    return prog in CONFIGURE_PROGS
+
+
+def fingerprint(obj):
+    """ Stable hex digest of any json serializable obj. """
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def expand_cmd(cmd, tdir, jobserver=None, env=None):
+    """ Substitute TARGET & JOBS in a build cmd.
+        With a jobserver make gets its jobs from MAKEFLAGS instead of -jJOBS.
+        env: extra environment variables for the cmd.
+        Returns (args, popen_kwargs).
+    """
+    kwargs = {}
+    if env:
+        kwargs['env'] = dict(os.environ, **env)
+    cmd = cmd.replace('TARGET', tdir)
+    if 'JOBS' in cmd:
+        if jobserver is not None:
+            cmd = cmd.replace('-jJOBS', '')
+            kwargs.update({'env': jobserver.env(kwargs.get('env')),
+                           'pass_fds': (jobserver.rfd, jobserver.wfd)})
+            jobs = jobserver.jobs
+        else:
+            jobs = os.cpu_count()
+        cmd = cmd.replace('JOBS', '%d' % jobs)
+
+    return shlex.split(cmd), kwargs
+
+
+def build_src(build, target=None, jobserver=None, fetched=False, root=None):
     """ Build a project downloeaded from url. build is a json object.
         The format is described below.
         Cmds are executed in srcdir, then if globs non-empty copy files as
         described in glob/target pairs.
+        The first cmd that fails stops the build, raising StepFailed.
+        Recipe files in RECIPE_DIR hold the same, name defaults to the
+        file name.
         Required names prefixed with R.
         {
           R 'name': 'ack',
           R 'check': 'path/to/check',
           R 'url': 'https://github.com/petdance/ack2.git',
             'tdir': /path/to/install/to,
+            'sha256': 'expected hex digest of archive url',
+            'fallbacks': ['urls', 'tried', 'in', 'turn', 'if', 'url', 'fails'],
+            'tree_mb': 'size the built source tree reaches, default guessed',
+            'deps': ['names', 'of', 'builds', 'needed', 'first'],
             'cmds': [
                 'perl Makefile.PL',
                 'make ack-standalone',
@@ -384,67 +1593,756 @@ def build_src(build, target=None):
                 ('blib/man1/*.1*', 'share/man/man1')
             ]
         }
+        jobserver: JobServer to take make jobs from, default all cpus.
+        fetched: source already put at srcdir by prefetch.
+        root: fast dir to keep srcdir in, default <tdir>/src.
+        Returns the Telemetry records of every step run.
     """
-    tdir = os.path.abspath(build.get('tdir', target))
-    srcdir = '%s/src/%s' % (tdir, build['name'])
+    tdir, srcdir = build_dirs(build, target, root)
+    tele = Telemetry(build['name'], SETTINGS['log'])
+    env = ccache_env(build, srcdir)
+
+    if SETTINGS['incremental']:
+        build_incremental(build, tdir, srcdir, jobserver, tele, env)
+        return tele.records
 
     # Guard if command exists
     if os.path.exists(tdir + os.sep + build['check']):
-        return
+        return tele.records
 
-    try:
-        get_archive(build['url'], srcdir)
-    except ArchiveNotSupported:
-        get_code(build['url'], srcdir)
+    key, stage = None, None
+    if SETTINGS['artifacts']:
+        with tele.step('artifact-key'):
+            key = artifact_key(build, tdir)
+    if key is not None:
+        with tele.step('restore', key):
+            restored = restore_artifact(key, tdir)
+        if restored:
+            print('Restored {} from artifact {}'.format(build['name'], key))
+            if fetched and os.path.exists(srcdir):
+                shutil.rmtree(srcdir)
+            return tele.records
+        # Stage the install so the files of this build can be packed
+        stage = srcdir + '-stage'
+        env['DESTDIR'] = stage
 
+    if not (fetched and os.path.exists(srcdir)):
+        fetch_src(build, srcdir, tele)
     try:
         # Code should be at srcdir by here.
-        PDir.push(srcdir)
-        for cmd in build.get('cmds', []):
-            cmd = cmd.replace('TARGET', tdir)
-            cmd = cmd.replace('JOBS', '%d' % multiprocessing.cpu_count())
-            subprocess.call(shlex.split(cmd))
-        PDir.pop()
-
-        # Manual copies sometimes required to finish install
-        for pattern, target in build.get('globs', []):
-            dest = tdir + os.sep + target
-            if dest.endswith('/') and not os.path.exists(dest):
-                os.makedirs(dest)
-
-            for sfile in glob.glob(srcdir + os.sep + pattern):
-                if os.path.isfile(sfile):
-                    shutil.copy(sfile, dest)
+        print('Building {} in {}'.format(build['name'], srcdir))
+        cmds = build.get('cmds', [])
+        codes = run_cmds(cmds, tdir, jobserver, env, tele, srcdir)
+        check_codes(build, cmds, codes)
+
+        with tele.step('globs'):
+            copy_globs(build, (stage or '') + tdir, srcdir)
+        if stage is not None:
+            with tele.step('package', key):
+                store_artifact(build, key, tdir, stage)
     finally:
         shutil.rmtree(srcdir)
+        if stage is not None and os.path.exists(stage):
+            shutil.rmtree(stage)
+
+    return tele.records
+
+
+def build_dirs(build, target=None, root=None):
+    """ The install dir & source dir of build.
+        root: where to keep srcdir instead of <tdir>/src.
+    """
+    tdir = os.path.abspath(build.get('tdir', target))
+    return tdir, '%s/%s' % (root or tdir + os.sep + 'src', build['name'])
+
+
+def tree_estimate(build):
+    """ Rough bytes the source tree of build reaches while building. """
+    if 'tree_mb' in build:
+        return build['tree_mb'] * 1024 ** 2
+    try:
+        archive = download_cache().path(build['url'])
+        return os.path.getsize(archive) * BUILD_ROOT_RATIO
+    except (ArchiveNotSupported, OSError):
+        return BUILD_ROOT_GUESS
+
+
+def fs_type(path):
+    """ Type of the filesystem path is on, like tmpfs, None if unknown. """
+    path = os.path.realpath(path)
+    best, kind = '', None
+    try:
+        with open('/proc/mounts') as fin:
+            for line in fin:
+                fields = line.split()
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) \
+                        and len(mount) > len(best):
+                    best, kind = mount, fields[2]
+    except (IOError, OSError, IndexError):
+        pass
+    return kind
+
+
+def mem_available():
+    """ Bytes of memory available without swapping, None if unknown. """
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def root_free(root):
+    """ Bytes source trees may still take in root.
+        A tmpfs is also bounded by available memory.
+    """
+    stat = os.statvfs(root)
+    free = stat.f_bavail * stat.f_frsize
+    mem = mem_available()
+    if fs_type(root) == 'tmpfs' and mem is not None:
+        free = min(free, mem)
+    return free - BUILD_ROOT_RESERVE
+
+
+def fetch_src(build, srcdir, tele=None):
+    """ Put the source of build at srcdir, either an archive or a repo.
+        The fallbacks of build are tried in turn when url fails.
+    """
+    import tarfile
+    tele = tele or Telemetry(None)
+    urls = [build['url']] + build.get('fallbacks', [])
+    for index, url in enumerate(urls):
+        try:
+            try:
+                get_archive(url, srcdir, build.get('sha256'), tele)
+            except ArchiveNotSupported:
+                with tele.step('clone', url):
+                    get_code(url, srcdir)
+            return
+        except (subprocess.CalledProcessError, OSError, IOError, Offline,
+                ChecksumMismatch, tarfile.TarError) as exc:
+            if index + 1 == len(urls):
+                raise
+            print('Fetching {} failed, trying {}: {}'.format(
+                url, urls[index + 1], exc))
+
+
+def run_cmds(cmds, tdir, jobserver=None, env=None, tele=None, cwd=None):
+    """ Run build cmds in cwd holding a jobserver token.
+        env: extra environment variables for the cmds.
+        tele: Telemetry to measure each cmd with.
+        Stops after the first cmd that fails.
+        Returns the exit code of each cmd run.
+    """
+    tele = tele or Telemetry(None)
+    codes = []
+    if jobserver is not None:
+        jobserver.acquire()
+    try:
+        for cmd in cmds:
+            args, kwargs = expand_cmd(cmd, tdir, jobserver, env)
+            codes.append(tele.run(args, cwd=cwd, **kwargs))
+            if codes[-1] != 0:
+                break
+    finally:
+        if jobserver is not None:
+            jobserver.release()
+
+    return codes
+
+
+def check_codes(build, cmds, codes):
+    """ Raise StepFailed if the last of the cmds run by run_cmds failed. """
+    if codes and codes[-1] != 0:
+        raise StepFailed('{}: `{}` exited with {}'.format(
+            build['name'], cmds[len(codes) - 1], codes[-1]))
+
+
+def copy_globs(build, tdir, srcdir):
+    """ Manual copies sometimes required to finish install. """
+    for pattern, target in build.get('globs', []):
+        dest = tdir + os.sep + target
+        if dest.endswith('/') and not os.path.exists(dest):
+            os.makedirs(dest)
+
+        for sfile in glob.glob(srcdir + os.sep + pattern):
+            if os.path.isfile(sfile):
+                shutil.copy(sfile, dest)
+
+
+def source_revision(build):
+    """ Identify the source build would fetch without fetching it all.
+        Archive sha256, remote revision of a repo or None if unknown.
+        Only archives without a pinned sha256 are downloaded.
+    """
+    url = build['url']
+    try:
+        find_archive(url)
+        if build.get('sha256'):
+            return build['sha256'].lower()
+        with fetched_archive(url) as archive:
+            with open(archive + '.sha256') as fin:
+                return fin.read().strip()
+    except ArchiveNotSupported:
+        pass
+
+    args = shlex.split(url)
+    kind = vcs_kind(url)
+    if kind == 'git':
+        ref = args[args.index('-b') + 1] if '-b' in args else 'HEAD'
+        cmd = ['git', 'ls-remote', args[-1], ref]
+    elif kind == 'svn':
+        cmd = ['svn', 'info', '--show-item', 'revision', args[-1]]
+    else:
+        cmd = ['hg', 'identify', '-i', args[-1]]
+
+    if SETTINGS['offline']:
+        return None
+    try:
+        out = check_output(cmd).decode().split()
+        return out[0] if out else None
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compiler_id():
+    """ First line of the C compiler's version, 'none' without one. """
+    try:
+        out = check_output([os.environ.get('CC', 'cc'), '--version'])
+        return out.decode().split('\n')[0]
+    except (subprocess.CalledProcessError, OSError):
+        return 'none'
+
+
+def artifact_key(build, tdir):
+    """ Key for the installed files of build, None if the source
+        revision can't be determined.
+    """
+    source = source_revision(build)
+    if source is None:
+        return None
+    recipe = dict((key, val) for key, val in build.items() if key != 'tdir')
+
+    return fingerprint({
+        'recipe': recipe,
+        'source': source,
+        'compiler': compiler_id(),
+        'prefix': tdir,
+    })
+
+
+def artifact_cache():
+    """ The artifact cache configured in SETTINGS. """
+    return ArtifactCache(SETTINGS['artifacts'], SETTINGS['artifacts_size'])
+
+
+def restore_artifact(key, tdir):
+    """ Stream the artifact for key straight into tdir.
+        Returns False if not cached.
+    """
+    artifact = artifact_cache().lookup(key)
+    if artifact is None:
+        return False
+
+    with open(artifact, 'rb') as fin:
+        with decompressed(fin, 'gz') as tarin:
+            untar(tarin, tdir)
+    return True
+
+
+def store_artifact(build, key, tdir, stage):
+    """ Pack the files build installed under stage, cache them under key
+        and install them to tdir.
+        Builds that ignore DESTDIR already installed to tdir, not cached.
+    """
+    root = stage + tdir
+    if not os.path.isdir(root):
+        print('{} ignored DESTDIR, not cached.'.format(build['name']))
+        return
+
+    import tarfile
+    tmp_file = '{}.{}.tar.gz'.format(stage, os.getpid())
+    try:
+        with tarfile.open(tmp_file, 'w:gz') as tarf:
+            for name in sorted(os.listdir(root)):
+                tarf.add(os.path.join(root, name), arcname=name)
+
+        with open(tmp_file, 'rb') as fin:
+            with decompressed(fin, 'gz') as tarin:
+                untar(tarin, tdir)
+
+        cache = artifact_cache()
+        if not os.path.exists(root + os.sep + build['check']):
+            print('{} partly ignored DESTDIR, not cached.'.format(
+                build['name']))
+        elif os.path.getsize(tmp_file) > cache.max_bytes:
+            print('{} artifact is bigger than the cache, not cached.'.format(
+                build['name']))
+        else:
+            cache.store(key, tmp_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def ccache_dir(*parts):
+    """ Path under the ccache dir in the cache dir. """
+    return os.path.join(SETTINGS['cache_dir'], 'ccache', *parts)
+
+
+def ccache_env(build, srcdir):
+    """ Environment sending every compiler call of build through ccache.
+        A dir of compiler named links to ccache goes first on the PATH,
+        so autotools, cmake & plain make all pick it up.
+        Empty if ccache is disabled or not installed.
+    """
+    stats = ccache_dir('stats', build['name'] + '.log')
+    if os.path.exists(stats):
+        os.remove(stats)
+    ccache = shutil.which('ccache')
+    if not SETTINGS['ccache_size'] or ccache is None:
+        return {}
+
+    links = ccache_dir('bin')
+    for path in (links, os.path.dirname(stats)):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+    for comp in CCACHE_COMPILERS:
+        link = os.path.join(links, comp)
+        if shutil.which(comp) and not os.path.lexists(link):
+            try:
+                os.symlink(ccache, link)
+            except OSError:
+                pass
+
+    return {
+        'PATH': links + os.pathsep + os.environ.get('PATH', ''),
+        'CCACHE_DIR': ccache_dir('cache'),
+        'CCACHE_MAXSIZE': '{}M'.format(SETTINGS['ccache_size'] // 1024 ** 2),
+        'CCACHE_BASEDIR': srcdir,
+        'CCACHE_STATSLOG': stats,
+    }
+
+
+def ccache_stats(name):
+    """ (hits, misses) of the compiles of build name in the last run,
+        None if ccache logged nothing, needs ccache >= 4.
+    """
+    try:
+        with open(ccache_dir('stats', name + '.log')) as fin:
+            results = [line.strip() for line in fin
+                       if not line.startswith('#')]
+    except (IOError, OSError):
+        return None
+    return (len([res for res in results if res in CCACHE_HITS]),
+            len([res for res in results if res in CCACHE_MISSES]))
+
+
+def print_ccache(names):
+    """ Table of ccache hits & misses of each build. """
+    rows = [(name, ccache_stats(name)) for name in sorted(names)]
+    rows = [(name, stats) for name, stats in rows if stats and sum(stats)]
+    if not rows:
+        return
+
+    fmt = '{:<12} {:>7} {:>7} {:>6}'
+    print('ccache results, cache: ' + ccache_dir('cache'))
+    print(fmt.format('build', 'hits', 'misses', 'rate'))
+    for name, (hits, misses) in rows:
+        print(fmt.format(name, hits, misses, '{:.0f}%'.format(
+            100.0 * hits / (hits + misses))))
+
+
+def update_src(build, srcdir, old_source):
+    """ Fetch or refresh the source of build kept at srcdir.
+        Returns (fresh, source, changed):
+            fresh: True if srcdir is a new tree, every step must run
+            source: sha256 of the archive or revision of the repo
+            changed: files changed since old_source, None if unknown
+    """
+    url = build['url']
+    try:
+        with fetched_archive(url, build.get('sha256')) as archive:
+            with open(archive + '.sha256') as fin:
+                source = fin.read().strip()
+            if source == old_source and os.path.isdir(srcdir):
+                return False, source, []
+
+            if os.path.exists(srcdir):
+                shutil.rmtree(srcdir)
+            extract_to(archive, srcdir)
+        return True, source, None
+    except ArchiveNotSupported:
+        pass
+
+    if old_source is None or not os.path.isdir(srcdir):
+        get_code(url, srcdir)
+        return True, code_revision(url, srcdir), None
+
+    update_code(url, srcdir)
+    source = code_revision(url, srcdir)
+    if source == old_source:
+        return False, source, []
+    return False, source, changed_files(url, srcdir, old_source, source)
+
+
+def build_incremental(build, tdir, srcdir, jobserver=None, tele=None,
+                      env=None):
+    """ Build keeping srcdir between runs, only rerun steps with new inputs.
+        A stamp beside srcdir records the source fingerprint and each
+        cmd that succeeded, keyed on the expanded cmds before it.
+        Configure steps are skipped if only sources changed.
+        env: extra environment variables for the cmds.
+    """
+    tele = tele or Telemetry(None)
+    stamp_file = srcdir + '.stamp'
+    try:
+        with open(stamp_file) as fin:
+            stamp = json.load(fin)
+    except (IOError, OSError, ValueError):
+        stamp = {}
+
+    with tele.step('update', build['url']):
+        fresh, source, changed = update_src(build, srcdir,
+                                            stamp.get('source'))
+    moved = source != stamp.get('source')
+    reconfigure = moved and configure_changed(changed)
+
+    cmds = build.get('cmds', [])
+    steps, last = [], ''
+    for cmd in cmds:
+        last = fingerprint([last, cmd.replace('TARGET', tdir)])
+        steps.append(last)
+    old_steps = stamp.get('steps', [])
+    installed = os.path.exists(tdir + os.sep + build['check'])
+
+    start = len(cmds)
+    for index, cmd in enumerate(cmds):
+        configure = is_configure(cmd)
+        if fresh or index >= len(old_steps) or steps[index] != old_steps[index] \
+                or (configure and reconfigure) \
+                or (not configure and (moved or not installed)):
+            start = index
+            break
+
+    globs = fingerprint(build.get('globs', []))
+    if start == len(cmds) and installed and globs == stamp.get('globs'):
+        print('Up to date: ' + build['name'])
+        return
+
+    print('Building {} in {}'.format(build['name'], srcdir))
+    codes = run_cmds(cmds[start:], tdir, jobserver, env, tele, srcdir)
+    done = start + len([code for code in codes if code == 0])
+
+    if done == len(cmds):
+        with tele.step('globs'):
+            copy_globs(build, tdir, srcdir)
+    with open(stamp_file, 'w') as fout:
+        json.dump({
+            'source': source,
+            'steps': steps[:done],
+            'globs': globs if done == len(cmds) else None,
+        }, fout)
+    check_codes(build, cmds[start:], codes)
 
 
 def build_wrap(args):
-    """ Wrapper for build_src in process pool.
-        Pool doesn't handle interrupt well, throw a different one. """
+    """ Wrapper for build_src in an executor.
+        Pool doesn't handle interrupt well, throw a different one.
+        Returns (wall seconds the build took, Telemetry records). """
     try:
-        build_src(*args)
+        start = time.time()
+        records = build_src(*args)
+        return time.time() - start, records
     except KeyboardInterrupt:
         raise WorkerInterrupted
 
 
-def build_pool(builds, target):
+def needs_prefetch(build, target):
+    """ Only fresh builds fetch into srcdir, incremental ones update
+        their kept tree when built.
+    """
+    tdir = build_dirs(build, target)[0]
+    return not SETTINGS['incremental'] and \
+        not os.path.exists(tdir + os.sep + build['check'])
+
+
+def prefetch(build, target, root=None):
+    """ Fetch the source of build ahead of building it.
+        root: fast dir to keep srcdir in, see build_src.
+        Returns the Telemetry records of the fetch.
+    """
+    tele = Telemetry(build['name'], SETTINGS['log'])
+    tdir, srcdir = build_dirs(build, target, root)
+    if SETTINGS['artifacts']:
+        # build_src will restore the artifact, the source isn't needed
+        with tele.step('artifact-key'):
+            key = artifact_key(build, tdir)
+        if key is not None and os.path.exists(artifact_cache().path(key)):
+            return tele.records
+
+    if os.path.exists(srcdir):
+        shutil.rmtree(srcdir)
+    try:
+        fetch_src(build, srcdir, tele)
+    except BaseException:
+        if os.path.exists(srcdir):
+            shutil.rmtree(srcdir)
+        raise
+    return tele.records
+
+
+def with_deps(builds, recipes):
+    """ Expand builds to include every build they depend on in recipes.
+        Deps come before the builds that need them, duplicates are dropped.
+        Deps without a recipe are assumed already installed, as topo_sort.
+    """
+    expanded = []
+    seen = set()
+
+    def visit(build, chain):
+        """ Depth first, deps added before build. """
+        if build['name'] in chain:
+            raise DependencyCycle(' -> '.join(chain + [build['name']]))
+        if build['name'] in seen:
+            return
+        for dep in build.get('deps', []):
+            if dep in recipes:
+                visit(recipes[dep], chain + [build['name']])
+        seen.add(build['name'])
+        expanded.append(build)
+
+    for build in builds:
+        visit(build, [])
+
+    return expanded
+
+
+def topo_sort(builds):
+    """ Order builds so every build follows its deps.
+        Deps not among builds are assumed already installed.
+        Raises DependencyCycle if no order exists.
+    """
+    names = [build['name'] for build in builds]
+    waiting = dict((build['name'], set(build.get('deps', [])) & set(names))
+                   for build in builds)
+    ordered = []
+    while waiting:
+        ready = sorted(name for name, deps in waiting.items() if not deps)
+        if not ready:
+            raise DependencyCycle(', '.join(sorted(waiting.keys())))
+        for name in ready:
+            del waiting[name]
+            for deps in waiting.values():
+                deps.discard(name)
+        ordered.extend(ready)
+
+    by_name = dict((build['name'], build) for build in builds)
+    return [by_name[name] for name in ordered]
+
+
+def critical_path(builds, times):
+    """ Find the longest chain of dependent builds by wall time.
+        times: dict of build name -> seconds taken, failed builds are left
+        out of the chain.
+        Returns (total_seconds, [names along chain]).
+    """
+    paths = {}
+    for build in topo_sort([build for build in builds
+                            if build['name'] in times]):
+        name = build['name']
+        best = (0, [])
+        for dep in build.get('deps', []):
+            if dep in paths and paths[dep][0] > best[0]:
+                best = paths[dep]
+        paths[name] = (best[0] + times.get(name, 0), best[1] + [name])
+
+    if not paths:
+        return (0, [])
+    return max(paths.values(), key=lambda path: path[0])
+
+
+def print_report(records, top=3):
+    """ Table of the slowest steps of each build by wall time. """
+    if not records:
+        return
+
+    def secs(val):
+        """ Unmeasured values print as - """
+        return '-' if val is None else '{:.1f}s'.format(val)
+
+    by_build = {}
+    for rec in records:
+        by_build.setdefault(rec['build'], []).append(rec)
+
+    fmt = '{:<12} {:<13} {:>8} {:>8} {:>8} {:>9}  {}'
+    print('Slowest steps, full log: ' + str(SETTINGS['log']))
+    print(fmt.format('build', 'step', 'wall', 'user', 'sys', 'max rss',
+                     'detail'))
+    for name in sorted(by_build):
+        steps = sorted(by_build[name], key=lambda rec: rec['wall'],
+                       reverse=True)
+        for rec in steps[:top]:
+            rss = rec['maxrss_kb']
+            print(fmt.format(
+                name, rec['step'], secs(rec['wall']), secs(rec['user']),
+                secs(rec['sys']),
+                '-' if rss is None else '{:.0f}MB'.format(rss / 1024.0),
+                rec['detail'][:50]))
+
+
+def build_pool(builds, target, jobs=None, executor='process'):
     """ Take a series of build objects and use a pool of workers
         to build them and install to target.
+        Sources are fetched up front by SETTINGS['fetch_jobs'] threads,
+        builds start as soon as their source is in & every dep among
+        builds has finished, dependents of a failed build are skipped.
+        Source trees go in SETTINGS['build_root'] while they fit.
+        jobs: total compile jobs across all builds, default all cpus.
+        executor: key of EXECUTORS to run builds with.
+        Returns names of builds that failed, were skipped or interrupted.
         NB: Blocks until all workers finished.
     """
-    pool_args = itertools.izip(builds, itertools.repeat(target))
-    pool = multiprocessing.Pool()
+    builds = topo_sort(builds)
+    names = set(build['name'] for build in builds)
+    waiting = dict((build['name'], set(build.get('deps', [])) & names)
+                   for build in builds)
+    by_name = dict((build['name'], build) for build in builds)
+    finished = queue.Queue()
+    times = {}
+    records = []
+    failed = []
+    running = set()
+    fetching = set(build['name'] for build in builds
+                   if needs_prefetch(build, target))
+    fetched = set()
+    roots = {}
+    reserved = {}
+    jobserver = JobServer(jobs or os.cpu_count())
+
+    def place(name):
+        """ Build root for the tree of name if it fits, None for disk. """
+        root = SETTINGS['build_root']
+        if name in roots or not root or SETTINGS['incremental']:
+            return roots.get(name)
+        need = tree_estimate(by_name[name])
+        if need <= root_free(root) - sum(reserved.values()):
+            reserved[name] = need
+            roots[name] = root
+        else:
+            print("Building {} on disk, ~{}MB won't fit in {}".format(
+                name, need // 1024 ** 2, root))
+            roots[name] = None
+        return roots[name]
+
+    def submit_ready():
+        """ Start every fetched build with no pending deps. """
+        for name in [name for name, deps in waiting.items()
+                     if not deps and name not in fetching]:
+            del waiting[name]
+            running.add(name)
+            pool.submit(build_wrap,
+                        (by_name[name], target, jobserver, name in fetched,
+                         place(name)),
+                        functools.partial(
+                            lambda name, res, exc: finished.put(
+                                ('build', name, res, exc)), name))
+
+    def drop_fetched(name):
+        """ Remove the prefetched source of a build that won't run. """
+        srcdir = build_dirs(by_name[name], target, roots.get(name))[1]
+        reserved.pop(name, None)
+        if name in fetched and os.path.exists(srcdir):
+            shutil.rmtree(srcdir)
+
+    def fetch_done(name, res, exc):
+        """ Queue the result of a prefetch for the main loop. """
+        finished.put(('fetch', name, res, exc))
+
+    def skip_dependents(name):
+        """ A build failed, anything waiting on it can never start. """
+        for other in [other for other, deps in waiting.items()
+                      if name in deps]:
+            print('Skipping {}, dep {} failed.'.format(other, name))
+            del waiting[other]
+            failed.append(other)
+            drop_fetched(other)
+            skip_dependents(other)
+
+    # No point running more builds than there are job tokens, except
+    # async where waiting builds are cheap & can fetch meanwhile
+    workers = len(builds)
+    if executor != 'async':
+        workers = min(workers, jobserver.jobs)
+    pool = EXECUTORS[executor](max(1, workers))
+    # Threads only after the process pool forked, network bound anyway
+    fetcher = ThreadExecutor(max(1, min(len(fetching),
+                                        SETTINGS['fetch_jobs'])))
     try:
-        pool.map(build_wrap, pool_args, 1)
+        # Topological order, so sources of the first builds land first
+        for build in builds:
+            if build['name'] in fetching:
+                fetcher.submit(lambda args: prefetch(*args),
+                               (build, target, place(build['name'])),
+                               functools.partial(fetch_done, build['name']))
+        submit_ready()
+        while running or fetching:
+            kind, name, res, exc = finished.get()
+            if kind == 'fetch':
+                fetching.discard(name)
+                if exc is None:
+                    fetched.add(name)
+                    records.extend(res)
+                    if name not in waiting:
+                        drop_fetched(name)
+                elif name in waiting:
+                    # Fetches were retried already, give up on it
+                    print('Failed to fetch {}: {}'.format(name, exc))
+                    del waiting[name]
+                    reserved.pop(name, None)
+                    failed.append(name)
+                    skip_dependents(name)
+                submit_ready()
+                continue
+
+            running.discard(name)
+            reserved.pop(name, None)
+            if exc is None:
+                times[name] = res[0]
+                records.extend(res[1])
+                for deps in waiting.values():
+                    deps.discard(name)
+            else:
+                print('Failed to install {}: {}'.format(name, exc))
+                failed.append(name)
+                skip_dependents(name)
+            submit_ready()
+        fetcher.close()
         pool.close()
-    except IOError as exc:
-        print('Failed to install: {}'.format(exc))
-        pool.terminate()
-    except (KeyboardInterrupt, Exception) as exc:
+    except (KeyboardInterrupt, Exception):
+        fetcher.terminate()
         pool.terminate()
+        failed.extend(sorted(names - set(times) - set(failed)))
     finally:
-        pool.join()
+        jobserver.close()
+
+    total, path = critical_path(builds, times)
+    if path:
+        print('Critical path ({:.1f}s): {}'.format(total, ' -> '.join(
+            '{} ({:.1f}s)'.format(name, times.get(name, 0))
+            for name in path)))
+    print_report(records)
+    print_ccache(times)
+    if failed:
+        print('Failed builds: ' + ', '.join(failed))
+
+    return failed
 
 
 def main():
@@ -473,21 +2371,66 @@ def main():
     odir = os.path.expanduser('~/.opt1')
     builds = []
 
-    # Use a dict of funcs to process args
-    dev_keys = (BUILDS['ack'], BUILDS['ag'], BUILDS['parallel'],
-                BUILDS['vimpager'], BUILDS['zsh_docs'])
+    # Use a dict of funcs to process args, only recipe names read here
+    dev_keys = ('ack', 'ag', 'parallel', 'vimpager', 'zsh_docs')
     actions = {
         'dev':  functools.partial(builds.extend, dev_keys),
     }
-    for key in BUILDS.keys():
-        if key not in dev_keys:
-            actions[key] = functools.partial(builds.append, BUILDS[key])
+    for key in BUILDS:
+        actions[key] = functools.partial(builds.append, key)
 
     parser = argparse.ArgumentParser(description=mesg,
                                      formatter_class=argparse.
                                      RawDescriptionHelpFormatter)
     parser.add_argument('-o', '--odir', nargs='?', default=None,
                         help='install dir')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='max compile jobs across all builds, '
+                        'default cpu count')
+    parser.add_argument('-e', '--executor', default='process',
+                        choices=sorted(EXECUTORS.keys()),
+                        help='how to run builds in parallel, '
+                        'default %(default)s')
+    parser.add_argument('--fetch-jobs', type=int,
+                        default=SETTINGS['fetch_jobs'],
+                        help='max sources fetched at once, '
+                        'default %(default)s')
+    parser.add_argument('--build-root', default=None,
+                        help='fast dir like a tmpfs to build in while '
+                        'trees fit, installs still go to odir, not used '
+                        'with -i')
+    parser.add_argument('--retries', type=int, default=SETTINGS['retries'],
+                        help='retries of a failed fetch, waits double '
+                        'each time, default %(default)s')
+    parser.add_argument('--cache-dir', default=SETTINGS['cache_dir'],
+                        help='download cache dir, default %(default)s')
+    parser.add_argument('--cache-size', type=int, default=2048,
+                        help='max download cache size in MB, '
+                        'default %(default)s')
+    parser.add_argument('--revalidate', type=float, default=1,
+                        help='hours before a cached archive without sha256 '
+                        'is checked against its server, default %(default)s')
+    parser.add_argument('--ccache-size', type=int, default=5120,
+                        help='max ccache size in MB when ccache installed, '
+                        '0 disables it, default %(default)s')
+    parser.add_argument('--log', default=SETTINGS['log'],
+                        help='json lines log of step timings, '
+                        'default %(default)s')
+    parser.add_argument('--offline', action='store_true', default=False,
+                        help='only build from the download cache')
+    parser.add_argument('--no-mirrors', dest='mirrors', action='store_false',
+                        default=True,
+                        help='clone repos directly, skip local mirrors')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        default=False,
+                        help='keep source trees, only rerun build steps '
+                        'whose inputs changed')
+    parser.add_argument('--artifacts', default=None,
+                        help='dir to cache & restore built files in, '
+                        'may be shared between hosts, not used with -i')
+    parser.add_argument('--artifacts-size', type=int, default=4096,
+                        help='max artifact cache size in MB, '
+                        'default %(default)s')
     parser.add_argument('keys', nargs='+', help='progs to build',
                         choices=sorted(actions.keys()))
 
@@ -497,13 +2440,31 @@ def main():
     # Nicer override than OPTDIR
     if args.odir is not None:
         odir = args.odir
+    SETTINGS.update({
+        'cache_dir': os.path.abspath(args.cache_dir),
+        'cache_size': args.cache_size * 1024 ** 2,
+        'log': os.path.abspath(args.log),
+        'offline': args.offline,
+        'mirrors': args.mirrors,
+        'incremental': args.incremental,
+        'artifacts': args.artifacts and os.path.abspath(args.artifacts),
+        'artifacts_size': args.artifacts_size * 1024 ** 2,
+        'fetch_jobs': args.fetch_jobs,
+        'ccache_size': args.ccache_size * 1024 ** 2,
+        'build_root': args.build_root and os.path.abspath(args.build_root),
+        'retries': args.retries,
+        'revalidate': args.revalidate * 3600,
+    })
+    if SETTINGS['build_root'] and not os.path.exists(SETTINGS['build_root']):
+        os.makedirs(SETTINGS['build_root'])
 
     try:
         for key in args.keys:
             actions[key]()
 
-        # build the components in parallel
-        build_pool(builds, odir)
+        # build the components in parallel, deps first
+        failed = build_pool(with_deps([BUILDS[name] for name in builds],
+                                      BUILDS), odir, args.jobs, args.executor)
     finally:
         try:
             os.removedirs(odir + os.path.sep + 'src')
@@ -511,5 +2472,8 @@ def main():
         except OSError:
             pass
 
+    if failed:
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()
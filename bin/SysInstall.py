@@ -9,10 +9,7 @@ import os
 import shlex
 import shutil
 import subprocess
-try:
-    import apt
-except ImportError:
-    print("Don't use `debian` option.")
+import time
 try:
     from argcomplete import autocomplete
 except ImportError:
@@ -20,8 +17,6 @@ except ImportError:
         """ Dummy func. """
         pass
 
-from BuildSrc import get_code
-
 # Packages to install follow, broken down into categories.
 MINIMUM = """ \
     pv vim build-essential git-core mercurial automake ccache fontconfig gdb lynx \
@@ -133,6 +128,15 @@ PY_PACKS = """ \
 
 DOT_FILES = os.path.join('.shell', 'dot', 'files')
 HOME_BAK = '.home_bak'
+# Touched after each successful apt-get update, by apt's periodic hook
+# & by packs_debian. List files carry the server's mtime, no use for age.
+APT_STAMP = '/var/lib/apt/periodic/update-success-stamp'
+# Tweaked by main from the command line
+SETTINGS = {
+    'apt_max_age': 6 * 3600,
+    'split_install': True,
+    'jobs': 6,
+}
 
 
 class NotSudo(Exception):
@@ -152,6 +156,190 @@ def do_in_home(some_func):
     return inner
 
 
+def repo_name(url):
+    """ Dir name a clone of url gets, like git picks. """
+    name = url.rstrip('/').split('/')[-1].split(':')[-1]
+    return name[:-4] if name.endswith('.git') else name
+
+
+def sync_repo(repo):
+    """ Clone url to target or fast forward an existing clone.
+        repo: (url, target)
+        Returns (target, seconds taken, what happened).
+    """
+    # Only repo syncs need BuildSrc, don't pay for it elsewhere
+    from BuildSrc import code_revision, get_code, update_code
+
+    url, target = repo
+    start = time.time()
+    try:
+        if not os.path.exists(target):
+            get_code(url, target)
+            status = 'cloned'
+        else:
+            old = code_revision(url, target)
+            if not update_code(url, target):
+                status = 'update failed'
+            elif code_revision(url, target) != old:
+                status = 'updated'
+            else:
+                status = 'up to date'
+    except (subprocess.CalledProcessError, OSError) as exc:
+        status = 'failed: {}'.format(exc)
+
+    return target, time.time() - start, status
+
+
+def sync_repos(repos):
+    """ sync_repo every (url, target) in repos, SETTINGS['jobs'] at once.
+        Progress is printed as each repo finishes.
+        Returns dict of target to what happened.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    start = time.time()
+    results = {}
+    pool = ThreadPool(max(1, min(SETTINGS['jobs'], len(repos))))
+    try:
+        for num, (target, secs, status) in enumerate(
+                pool.imap_unordered(sync_repo, repos), 1):
+            print('[{}/{}] {}: {} ({:.1f}s)'.format(
+                num, len(repos), target, status, secs))
+            results[target] = status
+    finally:
+        pool.close()
+        pool.join()
+    print('Synced {} repos in {:.1f}s'.format(len(repos), time.time() - start))
+
+    return results
+
+
+async def repo_cmd(path, args, log):
+    """ Coroutine running args in repo at path, output appended to log.
+        Returns (exit code, stripped output).
+    """
+    import asyncio
+
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0', HGPLAIN='1')
+    proc = await asyncio.create_subprocess_exec(
+        *args, cwd=path, env=env, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = (await proc.communicate())[0].decode('utf-8', 'replace')
+    log.append('$ {}\n{}'.format(' '.join(args), out))
+
+    return proc.returncode, out.strip()
+
+
+async def update_git(path, log):
+    """ Coroutine fast forwarding git repo at path.
+        The remote ref is asked for first, no fetch when it matches HEAD.
+    """
+    _, head = await repo_cmd(path, ['git', 'rev-parse', 'HEAD'], log)
+    code, upstream = await repo_cmd(path, [
+        'git', 'rev-parse', '--abbrev-ref', '--symbolic-full-name', '@{u}'],
+                                    log)
+    if code == 0 and '/' in upstream:
+        remote, branch = upstream.split('/', 1)
+        code, refs = await repo_cmd(path, [
+            'git', 'ls-remote', remote, 'refs/heads/' + branch], log)
+        if code != 0:
+            return 'failed'
+        if refs.split()[:1] == [head]:
+            return 'up to date'
+
+    code, _ = await repo_cmd(path, ['git', 'pull', '--ff-only'], log)
+    if code != 0:
+        return 'failed'
+    code, _ = await repo_cmd(path, [
+        'git', 'submodule', 'update', '--init', '--recursive'], log)
+    if code != 0:
+        return 'failed'
+
+    _, new = await repo_cmd(path, ['git', 'rev-parse', 'HEAD'], log)
+    if new == head:
+        return 'up to date'
+    return 'updated {}..{}'.format(head[:7], new[:7])
+
+
+async def update_hg(path, log):
+    """ Coroutine updating hg repo at path.
+        hg incoming exits 1 when the remote has nothing new, no pull then.
+    """
+    code, _ = await repo_cmd(path, ['hg', 'incoming', '--quiet'], log)
+    if code == 1:
+        return 'up to date'
+    if code != 0:
+        return 'failed'
+
+    _, old = await repo_cmd(path, ['hg', 'id', '-i'], log)
+    code, _ = await repo_cmd(path, ['hg', 'pull', '--update'], log)
+    if code != 0:
+        return 'failed'
+
+    _, new = await repo_cmd(path, ['hg', 'id', '-i'], log)
+    return 'updated {}..{}'.format(old, new)
+
+
+async def update_repo(path, limit):
+    """ Coroutine updating the git or hg repo at path, limit is a semaphore
+        bounding the repos talking to remotes at once.
+        Returns (path, seconds taken, what happened, buffered output).
+    """
+    log = []
+    async with limit:
+        start = time.time()
+        if os.path.isdir(os.path.join(path, '.git')):
+            status = await update_git(path, log)
+        elif os.path.isdir(os.path.join(path, '.hg')):
+            status = await update_hg(path, log)
+        else:
+            status = 'not a repo'
+
+    return path, time.time() - start, status, ''.join(log)
+
+
+def update_repos(paths):
+    """ Update every repo in paths, SETTINGS['jobs'] remotes at once.
+        Each repo's output is printed in one block when it finishes,
+        then a summary of what changed.
+        Returns dict of path to what happened.
+    """
+    import asyncio
+
+    async def run_all():
+        """ Update all, print as each finishes. """
+        limit = asyncio.Semaphore(max(1, SETTINGS['jobs']))
+        done = []
+        for fut in asyncio.as_completed([update_repo(path, limit)
+                                         for path in paths]):
+            path, secs, status, out = await fut
+            if status != 'up to date' and out:
+                print('>>> {}\n{}'.format(path, out.rstrip()))
+            done.append((path, secs, status))
+        return done
+
+    start = time.time()
+    done = asyncio.run(run_all())
+    width = max([len(os.path.basename(path)) for path in paths] + [4])
+    print('\n{:{w}}  {:6}  {}'.format('repo', 'secs', 'status', w=width))
+    for path, secs, status in sorted(done):
+        print('{:{w}}  {:6.1f}  {}'.format(os.path.basename(path), secs,
+                                          status, w=width))
+    changed = len([1 for _, _, status in done if status.startswith('updated')])
+    print('Updated {} of {} repos in {:.1f}s'.format(
+        changed, len(paths), time.time() - start))
+
+    return {path: status for path, _, status in done}
+
+
+def update_shell():
+    """ Update every repo in $SHELLD, ~/.shell by default. """
+    shelld = os.environ.get('SHELLD', os.path.expanduser('~/.shell'))
+    paths = sorted(path for path in glob.glob(os.path.join(shelld, '*'))
+                   if os.path.isdir(path))
+    update_repos(paths)
+
+
 @do_in_home
 def home_config():
     """ Setup the dev environment, stuff goes in the user's home folder. """
@@ -169,19 +357,19 @@ def home_config():
         'https://github.com/zsh-users/zsh-syntax-highlighting.git',
         'https://github.com/starcraftman/hhighlighter.git',
     ]
-    for url in git_urls:
-        target = url[url.rindex('/')+1:url.rindex('.git')]
-        get_code(url, os.path.join(shell_dir, target))
+    repos = [(url, os.path.join(shell_dir, repo_name(url)))
+             for url in git_urls]
+    repos.append(('https://bitbucket.org/sjl/hg-prompt/',
+                  os.path.join(shell_dir, 'hg-prompt')))
 
-    get_code('https://bitbucket.org/sjl/hg-prompt/',
-             os.path.join(shell_dir, 'hg-prompt'))
-
-    # Setup powerline fonts if not done.
+    # Setup powerline fonts if fc-cache around.
     font_dir = '.fonts'
-    if not os.path.exists(font_dir) and \
-            subprocess.call(['which', 'fc-cache']) == 0:
-        get_code('https://github.com/Lokaltog/powerline-fonts',
-                 os.path.join(font_dir, 'powerline'))
+    fonts = os.path.join(font_dir, 'powerline')
+    if subprocess.call(['which', 'fc-cache']) == 0:
+        repos.append(('https://github.com/Lokaltog/powerline-fonts', fonts))
+
+    results = sync_repos(repos)
+    if results.get(fonts) in ('cloned', 'updated'):
         subprocess.call(['fc-cache', '-vf', font_dir])
 
     files = [os.path.basename(x) for x in
@@ -261,37 +449,111 @@ def packs_cabal():
     subprocess.call(shlex.split(cmd))
 
 
+def apt_lists_age():
+    """ Seconds since apt-get update last succeeded, None if unknown. """
+    try:
+        return time.time() - os.path.getmtime(APT_STAMP)
+    except OSError:
+        return None
+
+
+def touch_apt_stamp():
+    """ Record a successful apt-get update in APT_STAMP. """
+    if not os.path.isdir(os.path.dirname(APT_STAMP)):
+        os.makedirs(os.path.dirname(APT_STAMP))
+    with open(APT_STAMP, 'a'):
+        os.utime(APT_STAMP, None)
+
+
+def apt_index(cache, arch):
+    """ Map name to package over the whole cache in one pass,
+        packages of the native arch win.
+    """
+    index = {}
+    for pkg in cache.packages:
+        if pkg.architecture == arch or pkg.name not in index:
+            index[pkg.name] = pkg
+    return index
+
+
+def apt_delta(index, names):
+    """ Resolve names against index, return (to install, not found).
+        A virtual name is satisfied by any installed provider,
+        else its first provider is installed.
+    """
+    wanted = set(names)
+    missing = wanted - set(index)
+    install = []
+    for name in sorted(wanted - missing):
+        pkg = index[name]
+        if pkg.current_ver is not None:
+            continue
+        if pkg.has_versions:
+            install.append(name)
+            continue
+
+        providers = [ver.parent_pkg for _, _, ver in pkg.provides_list]
+        if not providers:
+            missing.add(name)
+        elif not [prov for prov in providers if prov.current_ver is not None]:
+            install.append(providers[0].name)
+
+    return sorted(set(install)), sorted(missing)
+
+
 def packs_debian(server=False):
-    """ Install packages on the current system. """
+    """ Install packages on the current system.
+        Package lists are only updated when older than
+        SETTINGS['apt_max_age'], only missing packages are installed.
+    """
     if os.getuid() != 0:
         raise NotSudo
+    # Slow to import, only wanted here
+    try:
+        import apt_pkg
+    except ImportError:
+        print("Don't use `debian` option, python apt missing.")
+        raise
 
     if server:
         packages = MINIMUM.split()
     else:
         packages = (PROGRAMS + PROGRAMMING + KEYRINGS).split()
 
-    cache = apt.Cache()
-    print("One moment while we update cache.")
-    cache.update()
-    cache.open(None)
-    print("Update done.")
+    age = apt_lists_age()
+    if age is None or age > SETTINGS['apt_max_age']:
+        print("One moment while we update cache.")
+        if subprocess.call(['apt-get', 'update']) == 0:
+            touch_apt_stamp()
+        print("Update done.")
+    else:
+        print("Package lists updated {:.0f} min ago, skip update.".format(
+            age / 60))
 
-    cmd = 'sudo apt-get -y install'.split()
-    failed_debs = []
-    for pack in packages:
-        try:
-            package = cache[pack]
-            if not package.is_installed:
-                cmd.append(pack)
-        except KeyError:
-            print("Package couldn't be selected: %s" % pack)
-            failed_debs.append(pack)
+    apt_pkg.init()
+    cache = apt_pkg.Cache(None)
+    index = apt_index(cache, apt_pkg.config.find('APT::Architecture'))
+    install, failed_debs = apt_delta(index, packages)
+    for pack in failed_debs:
+        print("Package couldn't be selected: %s" % pack)
 
     print("Writing failed debs to {}".format(os.path.join(os.getcwd(), 'failed_debs')))
     with open('failed_debs', 'w') as fout:
         fout.write(os.linesep.join(failed_debs))
 
+    if not install:
+        print("All packages already installed.")
+        return
+
+    cmd = 'sudo apt-get -y install'.split() + install
+    if SETTINGS['split_install']:
+        # Fetch every archive first, apt downloads from mirrors in
+        # parallel, then dpkg unpacks from the local archive cache
+        print("Please wait, downloading {} packages.".format(len(install)))
+        if subprocess.call(cmd[:3] + ['--download-only'] + cmd[3:]) != 0:
+            print("Download failed, installing what is available.")
+        cmd = cmd[:3] + ['--no-download', '--fix-missing'] + cmd[3:]
+
     print("Please wait, running: " + " ".join(cmd))
     subprocess.call(cmd)
 
@@ -328,6 +590,7 @@ def main():
     server       Install debian packages for server, minimal.
     jshint       Install jshint via npm for javascript vim.
     pip          Install python libraries via pip.
+    update       Update every git & hg repo in $SHELLD concurrently.
     """
     # Use a dict of funcs to process args
     actions = {
@@ -340,15 +603,30 @@ def main():
         'server':       functools.partial(packs_debian, True),
         'jshint':       install_jshint,
         'pip':          packs_py,
+        'update':       update_shell,
     }
     parser = argparse.ArgumentParser(description=mesg,
                                      formatter_class=argparse.
                                      RawDescriptionHelpFormatter)
+    parser.add_argument('-j', '--jobs', type=int, default=SETTINGS['jobs'],
+                        help='repos fetched or updated at once, '
+                        'default %(default)s')
+    parser.add_argument('--apt-max-age', type=float, default=6,
+                        help='hours before apt package lists are updated, '
+                        'default %(default)s')
+    parser.add_argument('--no-split-install', dest='split_install',
+                        action='store_false', default=True,
+                        help='download & unpack debs in one apt-get run')
     parser.add_argument('stages', nargs='+', help='stages to execute',
                         choices=sorted(actions.keys()))
 
     autocomplete(parser)
     args = parser.parse_args()  # Default parses argv[1:]
+    SETTINGS.update({
+        'jobs': args.jobs,
+        'apt_max_age': args.apt_max_age * 3600,
+        'split_install': args.split_install,
+    })
 
     try:
         for stage in args.stages:
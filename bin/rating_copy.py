@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
 Provide a tool to copy music files from one directory to destination
@@ -6,92 +6,563 @@ if they are rated >= to a cutoff.
 Affects only FLAC and MP3 files.
 """
 import argparse
+import concurrent.futures as cfut
+import contextlib
 import functools
 import hashlib
+import io
 import logging
 import multiprocessing as multi
 import os
-import pathlib
-import shutil
-import subprocess as sub
+import queue
+import sqlite3
+import struct
 import sys
 import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FLAC_MAGIC = b'fLaC'
+FLAC_VORBIS_COMMENT = 4
+ID3_MAGIC = b'ID3'
+# Text encodings of ID3v2 frames, (codec, string terminator)
+ID3_ENCODINGS = {
+    0: ('latin-1', b'\x00'),
+    1: ('utf-16', b'\x00\x00'),
+    2: ('utf-16-be', b'\x00\x00'),
+    3: ('utf-8', b'\x00'),
+}
+RATING_KEY = 'fmps_rating'
+INDEX = os.path.expanduser('~/.cache/rating_copy/index.sqlite')
+INDEX_SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    rating REAL,
+    digest TEXT
+)"""
+MUSIC_EXTS = ('.flac', '.mp3')
+# Dirs listed at once, scandir waits on the disk or network not the cpu
+SCAN_JOBS = 16
+HASH_CHUNK = 1024 * 1024
+# Largest single copy_file_range/sendfile call
+COPY_CHUNK = 64 * 1024 * 1024
+# ioctl from linux/fs.h, share a whole file's extents on btrfs, xfs
+FICLONE = 0x40049409
+# Data copies running at once per destination device
+WRITE_JOBS = 2
+SAMPLE_SIZE = 64 * 1024
+# FAT players only keep mtimes to 2 seconds
+MTIME_WINDOW = 2
+# Per worker, path -> [size, mtime_ns, digest], set by init_worker
+DIGESTS = {}
+# Digests computed by this worker since its last result
+NEW_DIGESTS = {}
+# Per worker, st_dev -> semaphore shared by all workers, set by init_worker
+WRITE_LIMITS = {}
+# Per worker, dirs known to exist under destination
+MADE_DIRS = set()
+
+
+class TagError(Exception):
+    """
+    The tags of a file could not be parsed.
+    """
+    pass
+
+
+def syncsafe(data):
+    """
+    Decode an ID3v2 syncsafe integer, only 7 bits of each byte are used.
+
+    :param data bytes: The encoded integer.
+    """
+    num = 0
+    for byte in bytearray(data):
+        num = (num << 7) | (byte & 0x7f)
+
+    return num
+
+
+def unsync(data):
+    """
+    Undo ID3v2 unsynchronisation, every 0xFF 0x00 was written for 0xFF.
+
+    :param data bytes: The unsynchronised bytes.
+    """
+    return data.replace(b'\xff\x00', b'\xff')
+
+
+def split_text(data, term):
+    """
+    Split data at the first terminator, 2 byte terminators must be aligned.
+
+    :param data bytes: The encoded strings.
+    :param term bytes: The terminator of the encoding.
+    """
+    ind = data.find(term)
+    while len(term) == 2 and ind != -1 and ind % 2:
+        ind = data.find(term, ind + 1)
+    if ind == -1:
+        return data, b''
+
+    return data[:ind], data[ind + len(term):]
+
+
+def vorbis_rating(block):
+    """
+    Rating in a FLAC VORBIS_COMMENT block. 0 if no rating found.
+
+    :param block bytes: The body of the block.
+    """
+    vendor_len = struct.unpack_from('<I', block)[0]
+    pos = 4 + vendor_len
+    count = struct.unpack_from('<I', block, pos)[0]
+    pos += 4
+    for _ in range(count):
+        length = struct.unpack_from('<I', block, pos)[0]
+        pos += 4
+        key, _, value = block[pos:pos + length].partition(b'=')
+        pos += length
+        if key.decode('ascii', 'replace').lower() == RATING_KEY:
+            return float(value.decode('utf-8'))
+
+    return 0.0
+
+
+def txxx_rating(body):
+    """
+    Rating in an ID3v2 TXXX frame, None if the frame holds something else.
+
+    :param body bytes: The body of the frame.
+    """
+    codec, term = ID3_ENCODINGS[bytearray(body[:1])[0]]
+    desc, value = split_text(body[1:], term)
+    if desc.decode(codec).lower() != RATING_KEY:
+        return None
+
+    return float(value.decode(codec).strip('\x00'))
+
+
+def skip_id3(fin):
+    """
+    Seek past the ID3v2 tag at the start of fin, if any.
+
+    :param fin File: A file opened in binary mode.
+    """
+    fin.seek(0)
+    head = fin.read(10)
+    if len(head) == 10 and head[:3] == ID3_MAGIC:
+        # Size excludes the header and an optional 10 byte footer
+        fin.seek(10 + syncsafe(head[6:]) + (10 if bytearray(head)[5] & 0x10 else 0))
+    else:
+        fin.seek(0)
+
+
+def read_flac_rating(fname):
+    """
+    Read the rating from the VORBIS_COMMENT block of a FLAC file.
+    Only the metadata headers are read, other blocks like pictures are seeked past.
+    0 if no rating found.
+
+    :param fname String: The filename to investigate.
+    """
+    try:
+        with open(fname, 'rb') as fin:
+            skip_id3(fin)
+            if fin.read(4) != FLAC_MAGIC:
+                raise TagError("Not a FLAC file")
+
+            last = False
+            while not last:
+                head = bytearray(fin.read(4))
+                if len(head) != 4:
+                    raise TagError("Truncated FLAC metadata")
+                last = head[0] & 0x80
+                size = (head[1] << 16) | (head[2] << 8) | head[3]
+                if head[0] & 0x7f == FLAC_VORBIS_COMMENT:
+                    return vorbis_rating(fin.read(size))
+                fin.seek(size, os.SEEK_CUR)
+    except (struct.error, UnicodeDecodeError, ValueError) as exc:
+        raise TagError(str(exc))
+
+    return 0.0
+
+
+def read_mp3_rating(fname):
+    """
+    Read the rating from the TXXX:FMPS_Rating frame of an ID3v2 tag.
+    Only frame headers & TXXX frames are read, others are seeked past.
+    0 if no rating found.
+
+    :param fname String: The filename to investigate.
+    """
+    try:
+        with open(fname, 'rb') as fin:
+            head = bytearray(fin.read(10))
+            if len(head) != 10 or head[:3] != ID3_MAGIC:
+                return 0.0
+            major, flags = head[3], head[5]
+            end = 10 + syncsafe(head[6:])
+            tag = fin
+            if flags & 0x80 and major < 4:
+                # Whole tag unsynchronised, frame sizes apply after undoing it
+                tag = io.BytesIO(unsync(fin.read(end - 10)))
+                end = len(tag.getvalue())
+
+            if flags & 0x40 and major > 2:
+                ext = tag.read(4)
+                ext_size = syncsafe(ext) - 4 if major == 4 else struct.unpack('>I', ext)[0]
+                tag.seek(ext_size, os.SEEK_CUR)
+
+            id_len, head_len, want = (3, 6, b'TXX') if major == 2 else (4, 10, b'TXXX')
+            while tag.tell() + head_len <= end:
+                frame = bytearray(tag.read(head_len))
+                if len(frame) != head_len or not frame[:id_len].strip(b'\x00'):
+                    break  # Reached padding
+                if major == 2:
+                    size = (frame[3] << 16) | (frame[4] << 8) | frame[5]
+                elif major == 3:
+                    size = struct.unpack('>I', bytes(frame[4:8]))[0]
+                else:
+                    size = syncsafe(frame[4:8])
+
+                if bytes(frame[:id_len]) != want:
+                    tag.seek(size, os.SEEK_CUR)
+                    continue
+
+                body = tag.read(size)
+                if major == 4 and frame[9] & 0x01:
+                    body = body[4:]  # Data length indicator
+                if major == 4 and frame[9] & 0x02:
+                    body = unsync(body)
+                rating = txxx_rating(body)
+                if rating is not None:
+                    return rating
+    except (struct.error, KeyError, IndexError, UnicodeDecodeError, ValueError) as exc:
+        raise TagError(str(exc))
+
+    return 0.0
+
+
+def init_worker(digests, write_limits):
+    """
+    Pool initializer, give each worker the digest cache & write limits.
+
+    :param digests Dict: path -> [size, mtime_ns, digest]
+    :param write_limits Dict: st_dev -> multiprocessing semaphore
+    """
+    global DIGESTS, WRITE_LIMITS
+    DIGESTS = digests
+    WRITE_LIMITS = write_limits
+
+
+def open_index(fname):
+    """
+    Open the rating index, creating it if needed.
+
+    :param fname String: The sqlite file.
+    """
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    conn = sqlite3.connect(fname)
+    conn.execute(INDEX_SCHEMA)
+
+    return conn
+
+
+def load_index(conn, root):
+    """
+    Rows of the index for files under root.
+    Returns dict of path -> (size, mtime_ns, inode, rating, digest).
+
+    :param conn sqlite3.Connection: The open index.
+    :param root String: The absolute path of the scraped folder.
+    """
+    prefix = os.path.join(root, '')
+    rows = conn.execute('SELECT path, size, mtime_ns, inode, rating, digest FROM files '
+                        'WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+
+    return {row[0]: row[1:] for row in rows}
+
+
+def save_index(conn, index, rows):
+    """
+    Write rows that changed since index was loaded, drop files that are gone.
+
+    :param conn sqlite3.Connection: The open index.
+    :param index Dict: The rows loaded by load_index.
+    :param rows Dict: path -> (size, mtime_ns, inode, rating, digest) of this run.
+    """
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                         [(path,) + row for path, row in rows.items()
+                          if index.get(path) != row])
+        conn.executemany('DELETE FROM files WHERE path = ?',
+                         [(path,) for path in index if path not in rows])
+
+
+def scan_music(top, jobs=SCAN_JOBS):
+    """
+    Walk top with os.scandir, listing jobs dirs at once in threads.
+    Symlinked dirs are not followed.
+    Yields (path relative to top, stat) of every FLAC & MP3 as it is found.
+
+    :param top String: The folder to walk.
+    :param jobs Int: The number of dirs listed at once.
+    """
+    found = queue.Queue()
+    lock = threading.Lock()
+    pending = [0]  # Dirs submitted but not yet listed
+
+    def submit(rel):
+        """ Queue rel to be listed. """
+        with lock:
+            pending[0] += 1
+        executor.submit(list_dir, rel)
+
+    def list_dir(rel):
+        """ List rel, submit its dirs & put its music in found. """
+        try:
+            with os.scandir(os.path.join(top, rel)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        submit(os.path.join(rel, entry.name))
+                    elif os.path.splitext(entry.name)[1].lower() in MUSIC_EXTS:
+                        found.put((os.path.join(rel, entry.name), entry.stat()))
+        except OSError as exc:
+            logging.error("Failed to scan: %s\n%s", rel, str(exc))
+        finally:
+            with lock:
+                pending[0] -= 1
+                if not pending[0]:
+                    found.put(None)
+
+    executor = cfut.ThreadPoolExecutor(jobs)
+    try:
+        submit('')
+        for item in iter(found.get, None):
+            yield item
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def file_digest(fname, stat):
+    """
+    BLAKE2b digest of a file, read in HASH_CHUNK pieces.
+    Served from DIGESTS while size & mtime are unchanged.
+
+    :param fname String: The filename to hash.
+    :param stat os.stat_result: The stat of fname.
+    """
+    key = os.path.abspath(fname)
+    cached = DIGESTS.get(key)
+    if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+
+    digest = hashlib.blake2b()
+    with open(fname, 'rb') as fin:
+        for chunk in iter(functools.partial(fin.read, HASH_CHUNK), b''):
+            digest.update(chunk)
+    DIGESTS[key] = NEW_DIGESTS[key] = [stat.st_size, stat.st_mtime_ns,
+                                       digest.hexdigest()]
+
+    return digest.hexdigest()
+
+
+def same_samples(fname, fname2, size):
+    """
+    Compare SAMPLE_SIZE blocks at the start, middle and end of two files.
+
+    :param fname String: The first filename.
+    :param fname2 String: The second filename.
+    :param size Int: The size of both files.
+    """
+    offsets = {0, max(0, (size - SAMPLE_SIZE) // 2), max(0, size - SAMPLE_SIZE)}
+    with open(fname, 'rb') as fin, open(fname2, 'rb') as fin2:
+        for offset in sorted(offsets):
+            fin.seek(offset)
+            fin2.seek(offset)
+            if fin.read(SAMPLE_SIZE) != fin2.read(SAMPLE_SIZE):
+                return False
+
+    return True
 
 
 def same_files(fname, fname2):
     """
-    Two files are the same if they have the same hash.
+    Two files are the same if they have the same content, cheapest checks first.
+        - Sizes differ, not the same.
+        - Sizes & mtimes match, the same. Copies keep the source mtime.
+        - Sampled blocks differ, not the same.
+        - Otherwise compare full digests, see file_digest.
 
     :param fname String: The first filename.
     :param fname2 String: The second filename.
     """
     try:
-        hash1 = hashlib.sha512()
-        with open(fname, 'rb') as fin:
-            hash1.update(fin.read())
-
-        hash2 = hashlib.sha512()
-        with open(fname2, 'rb') as fin:
-            hash2.update(fin.read())
+        stat, stat2 = os.stat(fname), os.stat(fname2)
+        if stat.st_size != stat2.st_size:
+            return False
+        if abs(stat.st_mtime - stat2.st_mtime) <= MTIME_WINDOW:
+            return True
+        if not same_samples(fname, fname2, stat.st_size):
+            return False
+        if file_digest(fname, stat) != file_digest(fname2, stat2):
+            return False
 
-        return hash1.hexdigest() == hash2.hexdigest()
+        # Same content, match mtimes so later runs stop at the fast path
+        os.utime(fname2, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return True
     except IOError:
         return False
 
 
-def flac_rating(cutoff, destination, fname):
+def make_dirs(dname):
     """
-    FLAC rating of a file. 0 if no rating found.
+    os.makedirs, skipped for dirs this worker already made.
 
-    :param fname String: The filename to investigate.
+    :param dname String: The dir to make.
     """
-    rating = 0.0
-    try:
-        out = sub.check_output(['metaflac', '--list', fname]).decode()
-        ind = out.rindex("METADATA block #3")
-        for line in out[ind:].split('\n'):
-            if "FMPS_RATING=" in line:
-                rating = float(line.split('=')[1])
-                break
-    except sub.CalledProcessError as exc:
-        logging.error("Failed to query file: %s\n%s\n%s", fname, str(exc))
+    if dname not in MADE_DIRS:
+        os.makedirs(dname, exist_ok=True)
+        MADE_DIRS.add(dname)
 
-    if rating >= cutoff:
-        new_file = os.path.join(destination, fname)
+
+def copy_data(src, dst, size):
+    """
+    Copy size bytes between open fds the cheapest way available.
+    A reflink shares extents, copy_file_range & sendfile copy in the kernel,
+    python buffers are the last resort.
+    Returns the method used, raises OSError if a method stops short.
+
+    :param src Int: The fd to read.
+    :param dst Int: The fd to write, empty.
+    :param size Int: The size of src.
+    """
+    if fcntl:
         try:
-            os.makedirs(os.path.dirname(new_file))
+            fcntl.ioctl(dst, FICLONE, src)
+            return 'reflink'
         except OSError:
             pass
-        if not os.path.exists(new_file) or not same_files(fname, new_file):
-            logging.debug("Copying to destination: %s", fname)
-            shutil.copyfile(fname, new_file)
 
+    kernel = []
+    if hasattr(os, 'copy_file_range'):
+        kernel.append(('copy_file_range', lambda num: os.copy_file_range(src, dst, num)))
+    if hasattr(os, 'sendfile'):
+        kernel.append(('sendfile', lambda num: os.sendfile(dst, src, None, num)))
+    for method, func in kernel:
+        done = 0
+        try:
+            while done < size:
+                sent = func(min(COPY_CHUNK, size - done))
+                if not sent:
+                    break
+                done += sent
+        except OSError:
+            # Unsupported here, like copy_file_range across filesystems on old kernels
+            if done:
+                raise
+            continue
+        if done == size:
+            return method
+        # Nothing copied leaves the offsets alone, try the next method
+        if done:
+            raise OSError("Short copy by {}, {} of {} bytes".format(method, done, size))
+
+    for chunk in iter(functools.partial(os.read, src, HASH_CHUNK), b''):
+        os.write(dst, chunk)
+    return 'read'
 
-def mp3_rating(cutoff, destination, fname):
+
+def copy_file(fname, new_file, hardlink=False):
     """
-    MP3 rating of a file. 0 if no rating found.
+    Copy fname to new_file keeping its mtime.
+    When hardlink is set & both share a filesystem, link instead.
+    Data copies hold the write slot of the destination device, see WRITE_LIMITS.
+    Returns the method used.
 
-    :param fname String: The filename to investigate.
+    :param fname String: The file to copy.
+    :param new_file String: The copy to make or replace.
+    :param hardlink Bool: Link new_file to fname when possible.
     """
-    rating = 0.0
-    try:
-        out = sub.check_output(['mid3v2', '-l', fname]).decode()
-        for line in out.split('\n'):
-            if line.startswith("TXXX=FMPS_Rating"):
-                rating = float(line.split('=')[2])
-                break
-    except sub.CalledProcessError as exc:
-        logging.error("Failed to query file: %s\n%s\n%s", fname, str(exc))
+    stat = os.stat(fname)
+    make_dirs(os.path.dirname(new_file))
+    dev = os.stat(os.path.dirname(new_file)).st_dev
+    if hardlink and dev == stat.st_dev:
+        if os.path.lexists(new_file):
+            os.remove(new_file)
+        os.link(fname, new_file)
+        return 'hardlink'
+
+    with WRITE_LIMITS.get(dev, contextlib.nullcontext()):
+        with open(fname, 'rb') as fin, open(new_file, 'wb') as fout:
+            method = copy_data(fin.fileno(), fout.fileno(), stat.st_size)
+    os.utime(new_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    return method
+
+
+def copy_rated(cutoff, destination, fname, rating, hardlink=False):
+    """
+    Copy fname under destination if rated >= cutoff and not there already.
+    The copy keeps the mtime of fname, see copy_file.
+    Returns the digests computed by this worker since its last result.
 
+    :param cutoff Float: The minimum rating.
+    :param destination String: The folder to copy to.
+    :param fname String: The filename, relative to the scraped folder.
+    :param rating Float: The rating of fname.
+    :param hardlink Bool: Link instead of copying when possible.
+    """
     if rating >= cutoff:
         new_file = os.path.join(destination, fname)
         try:
-            os.makedirs(os.path.dirname(new_file))
-        except OSError:
-            pass
-        if not os.path.exists(new_file) or not same_files(fname, new_file):
-            logging.debug("Copying to destination: %s", fname)
-            shutil.copyfile(fname, new_file)
+            if not os.path.exists(new_file) or not same_files(fname, new_file):
+                method = copy_file(fname, new_file, hardlink)
+                logging.debug("Copied to destination by %s: %s", method, fname)
+        except OSError as exc:
+            logging.error("Failed to copy file: %s\n%s", fname, str(exc))
+
+    new_digests = dict(NEW_DIGESTS)
+    NEW_DIGESTS.clear()
+    return new_digests
+
+
+def read_rating(fname):
+    """
+    Read the rating of a FLAC or MP3 file, chosen by extension.
+    0 if no rating found.
+
+    :param fname String: The filename to investigate.
+    """
+    if fname.lower().endswith('.flac'):
+        return read_flac_rating(fname)
+
+    return read_mp3_rating(fname)
+
+
+def rate_file(cutoff, destination, hardlink, item):
+    """
+    Copy a FLAC or MP3 file if rated >= cutoff, unrated files count as 0.
+    The rating is only read from the file when the index had none.
+    Returns (fname, rating, new digests), rating is None if unreadable.
+
+    :param hardlink Bool: Link instead of copying when possible.
+    :param item Tuple: (filename to investigate, indexed rating or None)
+    """
+    fname, rating = item
+    if rating is None:
+        try:
+            rating = read_rating(fname)
+        except (OSError, TagError) as exc:
+            logging.error("Failed to query file: %s\n%s", fname, str(exc))
+
+    return fname, rating, copy_rated(cutoff, destination, fname, rating or 0.0, hardlink)
 
 
 def make_parser():
@@ -103,29 +574,20 @@ def make_parser():
     parser.add_argument('destination', help="The folder that you want to copy to on match.")
     parser.add_argument('--cutoff', '-c', type=float, default=1.0,
                         help="The cutoff to use. Default 1.0. Scale is 0.0 - 1.0, 4 stars = 0.8")
+    parser.add_argument('--index', default=INDEX,
+                        help="Ratings & digests of files, reused while unchanged. Default: " +
+                        INDEX)
+    parser.add_argument('--scan-jobs', type=int, default=SCAN_JOBS,
+                        help="Dirs listed at once. Default: {}".format(SCAN_JOBS))
+    parser.add_argument('--write-jobs', type=int, default=WRITE_JOBS,
+                        help="Files copied at once to the destination disk. Default: {}".format(
+                            WRITE_JOBS))
+    parser.add_argument('--hardlink', action='store_true',
+                        help="Hardlink instead of copying when on the same filesystem.")
 
     return parser
 
 
-def check_prereqs():
-    """
-    Check the prerequisites for inspecting ID3 tags.
-
-    If not met, print how to resolve and exit.
-    """
-    try:
-        sub.check_output(['metaflac', '--version'])
-    except sub.CalledProcessError:
-        print("Missing command: metaflac\n\nsudo apt install flac")
-        sys.exit(1)
-
-    try:
-        sub.check_output(['mid3v2', '--version'])
-    except sub.CalledProcessError:
-        print("Missing command: mid3v2\n\npip install mutagen")
-        sys.exit(1)
-
-
 def main():
     """
     Main entry for this program.
@@ -137,23 +599,49 @@ def main():
 
     args = make_parser().parse_args()
     args.destination = os.path.abspath(args.destination)
-    check_prereqs()
 
     try:
         orig = os.getcwd()
-        os.chdir(args.folder)
-        # Ensure globs are relative to root for joining
+        root = os.path.abspath(args.folder)
+        os.chdir(root)
+        conn = open_index(args.index)
+        index = load_index(conn, root)
+
+        # Files go to the pool as the walk finds them, relative to root for joining
+        stats, reread = {}, set()
+
+        def walk():
+            """ Pair each file found with its indexed rating, None if stat changed. """
+            for fname, stat in scan_music('.', args.scan_jobs):
+                path = os.path.join(root, fname)
+                stats[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                row = index.get(path)
+                rating = row[3] if row and row[:3] == stats[path] else None
+                if rating is None:
+                    reread.add(path)
+                yield fname, rating
 
-        pat = pathlib.Path(".")
-        mp3s = [str(x) for x in pat.glob("**/*.mp3")]
-        flacs = [str(x) for x in pat.glob("**/*.flac")]
-        if not mp3s and not flacs:
+        digests = {path: list(row[:2]) + [row[4]] for path, row in index.items() if row[4]}
+        # Copies to one disk contend for its head & bus, cap them over all workers
+        os.makedirs(args.destination, exist_ok=True)
+        write_limits = {os.stat(args.destination).st_dev: multi.BoundedSemaphore(args.write_jobs)}
+        rows = {}
+        with multi.Pool(8, init_worker, (digests, write_limits)) as pool:
+            for fname, rating, new_digests in pool.imap_unordered(
+                    functools.partial(rate_file, args.cutoff, args.destination, args.hardlink),
+                    walk(), 16):
+                digests.update(new_digests)
+                path = os.path.join(root, fname)
+                cached = digests.get(path)
+                digest = cached[2] if cached and cached[:2] == list(stats[path][:2]) else None
+                rows[path] = stats[path] + (rating, digest)
+        if not rows:
             print("Nothing matched, please check: " + args.folder)
             sys.exit(1)
 
-        with multi.Pool(8) as pool:
-            pool.map(functools.partial(flac_rating, args.cutoff, args.destination), flacs)
-            pool.map(functools.partial(mp3_rating, args.cutoff, args.destination), mp3s)
+        save_index(conn, index, rows)
+        conn.close()
+        print("Indexed {} files, read tags of {}.".format(len(rows), len(reread)))
     finally:
         tfile.close()
         os.chdir(orig)